@@ -4,20 +4,54 @@
 # Basically I have adapted that code to reflect the situation for the Alfen CarCharger instead of the SolarEdge Inverter
 # and limited myself to the Modbus TCP implementation only
 
+import collections
 import enum
+import random
+import struct
 import time
 import syslog
+import threading
+
+from socket import IPPROTO_TCP, TCP_NODELAY
 
 from pymodbus.constants import Endian
 from pymodbus.payload import BinaryPayloadBuilder
 from pymodbus.payload import BinaryPayloadDecoder
 from pymodbus.client import ModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusException, ModbusIOException
+from pymodbus.pdu import ExceptionResponse
 from pymodbus.register_read_message import ReadHoldingRegistersResponse
+from pymodbus.register_write_message import WriteMultipleRegistersResponse
 
 
 MAX_RETRIES = 3
 RETRY_DELAY = 1
 
+# Modbus PDU limit for a single read holding/input registers request
+MAX_READ_REGISTERS = 125
+# Modbus PDU limit for a single write multiple registers request
+MAX_WRITE_REGISTERS = 123
+# Largest hole (in registers) bridged when coalescing two registers into one request
+MAX_GAP = 10
+# Requests in flight at once on a pipelined connection, 1 disables pipelining
+PIPELINE_WINDOW = 1
+# Seconds a persistent connection may stay unused before it is closed
+IDLE_TIMEOUT = 30
+# First retry delay in seconds, doubled for every further attempt
+RETRY_BACKOFF = 0.1
+# Request outcomes worth retrying. An exception response means the charger
+# understood and refused the request, asking again won't change its mind,
+# "invalid" (an error in the calling code) fails the same way every time, and
+# "open" (the circuit breaker) is meant to fail fast.
+RETRYABLE = frozenset(("disconnected", "timeout", "short", "error"))
+# Seconds an open circuit breaker fails fast before probing the charger again
+BREAKER_COOLDOWN = 30
+# Highest unicast slave ID, slave 0 is the broadcast address
+MAX_SLAVE_ID = 247
+# Seconds to wait for the charger to account for a new setpoint, and how often to check
+SETPOINT_TIMEOUT = 5
+SETPOINT_POLL_INTERVAL = 0.1
+
 class registerType(enum.Enum):
     INPUT = 1
     HOLDING = 2
@@ -34,6 +68,19 @@ class registerDataType(enum.Enum):
     FLOAT64 = 8
     STRING = 9
 
+
+class registerClass(enum.Enum):
+    IDENTITY = 1
+    MEASUREMENT = 2
+    SETPOINT = 3
+
+
+class breakerState(enum.Enum):
+    CLOSED = 1
+    OPEN = 2
+    HALF_OPEN = 3
+
+
 METER_TYPE_MAP = {
     "0": "RTU",
     "1": "TCP/IP",
@@ -87,21 +134,412 @@ MODBUS_SLAVE_MAX_CURRENT_ENABLE_MAP = {
     "1": "Enabled"
 }
 
+# Seconds a cached register value stays valid, per register class
+CACHE_TTL = {
+    registerClass.IDENTITY: float("inf"),
+    registerClass.MEASUREMENT: 1,
+    registerClass.SETPOINT: 0
+}
+
+# struct format characters for the numeric register data types, big endian
+STRUCT_FORMATS = {
+    registerDataType.UINT16: "H",
+    registerDataType.UINT32: "I",
+    registerDataType.ACC32: "I",
+    registerDataType.UINT64: "Q",
+    registerDataType.INT16: "h",
+    registerDataType.FLOAT32: "f",
+    registerDataType.SEFLOAT: "f",
+    registerDataType.FLOAT64: "d"
+}
+
+STRUCT_TYPES = {
+    "H": int, "I": int, "Q": int, "h": int,
+    "f": float, "d": float
+}
+
+# Modbus TCP frames used by the pipelined read path: MBAP header (transaction,
+# protocol, length, unit) plus a read holding registers PDU (function, address, count)
+READ_REQUEST = struct.Struct(">HHHBBHH")
+MBAP_HEADER = struct.Struct(">HHHB")
+
+
+# One poll from AlfenEve.stream(): values is a tuple in the order of keys (None where a
+# register could not be read), missed counts the slots skipped since the previous sample.
+Sample = collections.namedtuple("Sample", "timestamp keys values missed")
+
+
+# One register map entry. Being a tuple, it unpacks like the plain 9-tuples the
+# register maps are written as.
+Register = collections.namedtuple("Register", "slave address length rtype dtype vtype label unit batch")
+
+
+# One Modbus request as reported to Instrument.on_request(). function is the Modbus
+# function code, outcome one of "ok", "exception", "short", "timeout" or "error" and
+# sent/received are the bytes on the wire (MBAP header included).
+RequestEvent = collections.namedtuple("RequestEvent", "function slave address length duration outcome sent received")
+
+
+def _read_outcome(result, length):
+    if isinstance(result, ReadHoldingRegistersResponse):
+        return "ok" if len(result.registers) == length else "short"
+    if isinstance(result, ExceptionResponse):
+        return "exception"
+    if isinstance(result, ModbusIOException):
+        return "timeout"
+
+    return "error"
+
+
+def _write_outcome(result):
+    if isinstance(result, WriteMultipleRegistersResponse):
+        return "ok"
+    if isinstance(result, ExceptionResponse):
+        return "exception"
+    if isinstance(result, ModbusIOException):
+        return "timeout"
+
+    return "error"
+
+
+def _read_event(slave, address, length, duration, outcome, result):
+    if outcome == "ok" or outcome == "short":
+        received = 9 + 2 * len(result.registers)
+    else:
+        received = 9 if outcome == "exception" else 0
+
+    return RequestEvent(3, slave, address, length, duration, outcome, 12, received)
+
+
+def _write_event(slave, address, length, duration, outcome):
+    return RequestEvent(16, slave, address, length, duration, outcome, 13 + 2 * length, 0 if outcome == "timeout" else 12 if outcome == "ok" else 9)
+
+
+def _exception_outcome(e):
+    if isinstance(e, BreakerOpenException):
+        return "open"
+    if isinstance(e, ConnectionException):
+        return "disconnected"
+    if isinstance(e, ModbusIOException):
+        return "timeout"
+    if isinstance(e, (ModbusException, OSError)):
+        return "error"
+
+    # anything else is a bug (an unknown key, a value that can't be encoded)
+    return "invalid"
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter, bounded by attempts and a time budget.
+
+    Shared by the blocking and asyncio classes: delay() only does the
+    arithmetic, the caller does the sleeping.
+    """
+
+    def __init__(
+        self, attempts=MAX_RETRIES, backoff=RETRY_BACKOFF, multiplier=2, max_backoff=RETRY_DELAY,
+        jitter=0.5, budget=None, retry_on=RETRYABLE
+    ):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.budget = budget
+        self.retry_on = frozenset(retry_on)
+
+    def __repr__(self):
+        return f"RetryPolicy(attempts={self.attempts}, backoff={self.backoff}, max_backoff={self.max_backoff}, budget={self.budget})"
+
+    def deadline(self):
+        """Monotonic time by which a call has to give up, or None without a budget."""
+        if self.budget is None:
+            return None
+
+        return time.monotonic() + self.budget
+
+    def expired(self, deadline):
+        return deadline is not None and time.monotonic() >= deadline
+
+    def delay(self, attempt, outcome, deadline=None):
+        """Seconds to wait after failed attempt number `attempt`, or None to give up."""
+        if attempt >= self.attempts or outcome not in self.retry_on:
+            return None
+
+        delay = min(self.backoff * self.multiplier ** (attempt - 1), self.max_backoff)
+        delay -= delay * self.jitter * random.random()
+
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+
+        return delay
+
+
+class CircuitBreaker:
+    """Fail fast on a charger after `threshold` consecutive failed reads.
+
+    After `cooldown` seconds a single caller is let through to probe the
+    charger: success closes the breaker, failure opens it for another cooldown.
+    """
+
+    def __init__(self, threshold, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = breakerState.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"CircuitBreaker({self.state.name}: failures={self.failures}/{self.threshold}, cooldown={self.cooldown})"
+
+    def is_open(self):
+        """True while requests fail fast, schedulers can skip the charger until then."""
+        return self.state is not breakerState.CLOSED and self.remaining() > 0
+
+    def remaining(self):
+        if self.state is breakerState.CLOSED:
+            return 0
+
+        return max(self.opened + self.cooldown - time.monotonic(), 0)
+
+    def acquire(self):
+        """CLOSED: go ahead, OPEN: fail fast, HALF_OPEN: probe and report back."""
+        with self._lock:
+            if self.state is breakerState.CLOSED:
+                return breakerState.CLOSED
+            if self.state is breakerState.OPEN and time.monotonic() - self.opened >= self.cooldown:
+                self.state = breakerState.HALF_OPEN
+                return breakerState.HALF_OPEN
+
+            # still cooling down, or another caller is probing
+            return breakerState.OPEN
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = breakerState.CLOSED
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self.state is breakerState.HALF_OPEN or self.failures >= self.threshold:
+                self.state = breakerState.OPEN
+                self.opened = time.monotonic()
+
+
+class BreakerOpenException(ConnectionException):
+    """Raised instead of contacting a charger while its circuit breaker is open."""
+
+
+class Instrument:
+    """Instrumentation hooks, pass an instance as AlfenEve(instrument=...).
+
+    Override the hooks you are interested in. When no instrument is set, the
+    hooks cost a single attribute check per request.
+    """
+
+    def on_connect(self, charger, connected, duration):
+        pass
+
+    def on_disconnect(self, charger):
+        pass
+
+    def on_request(self, charger, event):
+        pass
+
+    def on_retry(self, charger, attempt, reason):
+        pass
+
+    def on_decode(self, charger, plan, duration):
+        pass
+
+
+def _decode_string(data):
+    return data.decode(encoding="utf-8", errors="ignore").replace("\x00", "").rstrip()
+
+
+class DecodePlan:
+    """Decodes one request span (a dict of registers of the same slave, sorted by
+    address) with a single struct.unpack_from() over the raw register words.
+
+    With little word order, the words of every multi-register number are put in
+    big word order first, strings are left as they are.
+    """
+
+    __slots__ = ("slave", "rtype", "address", "length", "registers", "keys", "words", "struct", "conversions", "order")
+
+    def __init__(self, registers, wordorder=Endian.BIG):
+        first = next(iter(registers.values()))
+        self.slave = first[0]
+        self.rtype = first[3]
+        self.address = first[1]
+        self.length = max(v[1] + v[2] for v in registers.values()) - self.address
+        self.registers = registers
+        self.keys = tuple(registers)
+
+        fmt = ">"
+        offset = self.address
+        self.conversions = []
+        # word indexes in big word order, None when the span is already
+        self.order = None
+        order = list(range(self.length))
+
+        for k, v in registers.items():
+            slave, address, length, rtype, dtype, vtype, label, unit, batch = v
+
+            if address > offset:
+                fmt += f"{(address - offset) * 2}x"
+
+            if dtype == registerDataType.STRING:
+                fmt += f"{length * 2}s"
+                self.conversions.append((k, _decode_string))
+            elif dtype in STRUCT_FORMATS:
+                fmt += STRUCT_FORMATS[dtype]
+                if STRUCT_TYPES[STRUCT_FORMATS[dtype]] is not vtype:
+                    self.conversions.append((k, vtype))
+                if wordorder != Endian.BIG and length > 1:
+                    start = address - self.address
+                    order[start:start + length] = order[start:start + length][::-1]
+            else:
+                raise NotImplementedError(dtype)
+
+            offset = address + length
+
+        self.words = struct.Struct(f">{self.length}H")
+        self.struct = struct.Struct(fmt)
+
+        if order != sorted(order):
+            self.order = tuple(order)
+
+    def __repr__(self):
+        return f"DecodePlan(slave={self.slave}, address={self.address}, length={self.length}, registers={len(self.keys)})"
+
+    def pack(self, registers):
+        return self.words.pack(*registers)
+
+    def decode(self, registers):
+        return self.decode_bytes(self.pack(registers))
+
+    def big_words(self, data):
+        """The raw span data with every number in big word order."""
+        if self.order is None:
+            return data
+
+        words = self.words.unpack_from(data)
+        return self.words.pack(*[words[i] for i in self.order])
+
+    def decode_bytes(self, data):
+        results = dict(zip(self.keys, self.struct.unpack_from(self.big_words(data))))
+
+        for k, convert in self.conversions:
+            results[k] = convert(results[k])
+
+        return results
+
+
+class RegisterTable:
+    """A register map compiled once per class.
+
+    Holds the Register entries with indexes by register type, slave and group,
+    and caches the derived per-socket maps and decode plans for all instances.
+    """
+
+    __slots__ = ("registers", "by_rtype", "by_slave", "groups", "sockets", "plans")
+
+    def __init__(self, registers, groups=None):
+        self.registers = {k: Register(*v) for k, v in registers.items()}
+        self.by_rtype = {}
+        self.by_slave = {}
+
+        for k, v in self.registers.items():
+            self.by_rtype.setdefault(v.rtype, []).append(k)
+            self.by_slave.setdefault(v.slave, []).append(k)
+
+        self.by_rtype = {k: tuple(v) for k, v in self.by_rtype.items()}
+        self.by_slave = {k: tuple(v) for k, v in self.by_slave.items()}
+        self.groups = {k: tuple(v) for k, v in (groups or {}).items()}
+        self.sockets = {}
+        self.plans = {}
+
+    def __repr__(self):
+        return f"RegisterTable({len(self.registers)} registers: {len(self.plans)} plans)"
+
+    def socket_registers(self, socket_slave, socket):
+        # every socket uses the same register map, only on its own slave ID
+        if socket not in self.sockets:
+            self.sockets[socket] = {
+                k: v._replace(slave=socket) if v.slave == socket_slave else v
+                for k, v in self.registers.items()
+            }
+
+        return self.sockets[socket]
+
+    def keys(self, slave, rtype):
+        return tuple(k for k in self.by_slave.get(slave, ()) if self.registers[k].rtype == rtype)
+
+
+# RegisterTables by id() of their compiled register dict and by their groups, so
+# classes sharing a register map and groups (CarCharger and AsyncCarCharger)
+# share one table, while a subclass with its own groups gets its own
+_register_tables = {}
+
+
+def _groups_key(groups):
+    return tuple((k, tuple(v)) for k, v in groups.items())
+
+
 class AlfenEve:
 
     model = "Alfen Eve"
     wordorder = Endian.BIG
 
+    # registers not listed here are cached as registerClass.MEASUREMENT
+    register_classes = {}
+    # group name: register names, usable wherever read_many() takes keys
+    register_groups = {}
+    # cheap single register read used to probe a half-open circuit breaker
+    probe_register = None
+    # slave ID of the socket registers in `registers`, socket n is served on slave n
+    socket_slave = None
+
+    registers = {}
+    register_table = RegisterTable(registers)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        groups = _groups_key(cls.register_groups)
+        table = _register_tables.get((id(cls.registers), groups))
+        if table is None:
+            table = RegisterTable(cls.registers, cls.register_groups)
+            _register_tables[(id(table.registers), groups)] = table
+
+        cls.register_table = table
+        cls.registers = table.registers
+
     def __init__(
         self, host=False, port=False,
         timeout=RETRY_DELAY, retries=MAX_RETRIES,
-        parent=False
+        max_gap=MAX_GAP, pipeline=PIPELINE_WINDOW, persistent=False, idle_timeout=IDLE_TIMEOUT,
+        cache=False, cache_ttl=None, instrument=None, retry_policy=None,
+        breaker_threshold=None, breaker_cooldown=BREAKER_COOLDOWN, parent=False
     ):
 
         if parent:
             self.client = parent.client
             self.timeout = parent.timeout
             self.retries = parent.retries
+            self.max_gap = parent.max_gap
+            self.pipeline = parent.pipeline
+            self.persistent = parent.persistent
+            self.idle_timeout = parent.idle_timeout
+            self.cache = parent.cache
+            self.cache_ttl = parent.cache_ttl
+            self.instrument = parent.instrument
+            self.retry_policy = parent.retry_policy
+            self.breaker = parent.breaker
 
             self.host = parent.host
             self.port = parent.port
@@ -111,36 +549,130 @@ class AlfenEve:
 
             self.timeout = timeout
             self.retries = retries
-
-            self.client = ModbusTcpClient(
-                host=self.host,
-                port=self.port,
-                timeout=self.timeout
-            )
+            self.max_gap = max_gap
+            self.pipeline = pipeline
+            self.persistent = persistent
+            self.idle_timeout = idle_timeout
+            self.cache = cache
+            self.cache_ttl = {**CACHE_TTL, **(cache_ttl or {})}
+            self.instrument = instrument
+            self.retry_policy = retry_policy or RetryPolicy(attempts=retries, max_backoff=timeout)
+            self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown) if breaker_threshold else None
+
+            self.client = self._create_client()
+
+        self._nr_of_sockets = None
+        self._transaction = 0
+
+        self._previous = {}
+
+        self._cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self._session_lock = threading.Lock()
+        self._session_users = 0
+        self._last_used = 0
+        self._idle_timer = None
+
+    def _create_client(self):
+        return ModbusTcpClient(
+            host=self.host,
+            port=self.port,
+            timeout=self.timeout
+        )
 
     def __repr__(self):
         return f"{self.model}({self.host}:{self.port}: timeout={self.timeout}, retries={self.retries})"
 
     def _read_holding_registers(self, slave, address, length):
-        for i in range(self.retries):
-            if not self.connected():
-                self.connect()
-                time.sleep(0.1)
-                continue
+        registers = self._read_holding_words(slave, address, length)
 
-            result = self.client.read_holding_registers(address, length, slave=slave)
+        if registers is None:
+            return None
 
-            if not isinstance(result, ReadHoldingRegistersResponse):
-                continue
-            if len(result.registers) != length:
-                continue
+        return BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=self.wordorder)
 
-            return BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.BIG, wordorder=self.wordorder)
+    def _probe(self):
+        if not (self.connected() or self.connect()):
+            return False
+        if self.probe_register is None:
+            return True
 
-        return None
+        slave, address, length = self.registers[self.probe_register][:3]
+
+        return _read_outcome(self.client.read_holding_registers(address, length, slave=slave), length) == "ok"
+
+    def _breaker_allow(self):
+        state = self.breaker.acquire()
+
+        if state is breakerState.HALF_OPEN:
+            if self._probe():
+                self.breaker.success()
+                return True
+
+            self.breaker.failure()
+            return False
+
+        return state is breakerState.CLOSED
+
+    def _read_holding_words(self, slave, address, length, deadline=None):
+        policy = self.retry_policy
+        instrument = self.instrument
+        breaker = self.breaker
+        attempt = 0
+
+        if breaker is not None and not self._breaker_allow():
+            return None
+
+        if deadline is None:
+            deadline = policy.deadline()
+        elif policy.expired(deadline):
+            return None
+
+        while True:
+            if self.connected() or self.connect():
+                if instrument is not None:
+                    start = time.perf_counter()
+
+                result = self.client.read_holding_registers(address, length, slave=slave)
+                outcome = _read_outcome(result, length)
+
+                if instrument is not None:
+                    instrument.on_request(self, _read_event(slave, address, length, time.perf_counter() - start, outcome, result))
+
+                if outcome == "ok":
+                    if breaker is not None:
+                        breaker.success()
+                    return result.registers
+            else:
+                outcome = "disconnected"
+
+            attempt += 1
+            delay = policy.delay(attempt, outcome, deadline)
+
+            if delay is None:
+                # an exception response still proves the charger is alive
+                if breaker is not None and outcome != "exception":
+                    breaker.failure()
+                return None
+            if instrument is not None:
+                instrument.on_retry(self, attempt, outcome)
+
+            time.sleep(delay)
 
     def _write_holding_register(self, slave, address, value):
-        return self.client.write_registers(address=address, values=value, slave=slave)
+        if self.breaker is not None and not self._breaker_allow():
+            raise BreakerOpenException(f"{self.host}:{self.port}: circuit breaker open")
+
+        if self.instrument is None:
+            return self.client.write_registers(address=address, values=value, slave=slave)
+
+        start = time.perf_counter()
+        result = self.client.write_registers(address=address, values=value, slave=slave)
+        self.instrument.on_request(self, _write_event(slave, address, len(value), time.perf_counter() - start, _write_outcome(result)))
+
+        return result
 
     def _encode_value(self, data, dtype):
         builder = BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=self.wordorder)
@@ -209,53 +741,265 @@ class AlfenEve:
         except AttributeError:
             return False
 
-    def _read_all(self, values, rtype):
-        addr_min = False
-        addr_max = False
+    def _read_raw(self, plan, rtype, deadline=None):
+        try:
+            if rtype == registerType.INPUT:
+                data = self._read_input_registers(plan.slave, plan.address, plan.length)
+            elif rtype == registerType.HOLDING:
+                data = self._read_holding_words(plan.slave, plan.address, plan.length, deadline)
+            else:
+                raise NotImplementedError(rtype)
+        except NotImplementedError:
+            raise
+
+        if not data:
+            return None
 
-        for k, v in values.items():
-            v_slave = v[0]
-            v_addr = v[1]
-            v_length = v[2]
+        return plan.pack(data)
+
+    def _decode(self, plan, data):
+        if self.instrument is None:
+            return plan.decode_bytes(data)
+
+        start = time.perf_counter()
+        values = plan.decode_bytes(data)
+        self.instrument.on_decode(self, plan, time.perf_counter() - start)
+
+        return values
 
-            if addr_min is False:
-                addr_min = v_addr
-            if addr_max is False:
-                addr_max = v_addr + v_length
+    def _recv_exactly(self, sock, size, deadline):
+        data = bytearray()
 
-            if v_addr < addr_min:
-                addr_min = v_addr
-            if (v_addr + v_length) > addr_max:
-                addr_max = v_addr + v_length
+        while len(data) < size:
+            sock.settimeout(max(min(self.timeout, deadline - time.monotonic()), 0.001))
+            chunk = sock.recv(size - len(data))
 
+            if not chunk:
+                raise ConnectionError("connection closed by charger")
+
+            data += chunk
+
+        return data
+
+    def _read_pipelined(self, plans, deadline=None):
+        # Sends up to self.pipeline read requests back to back on the client's
+        # socket and matches the responses by transaction ID. Returns
+        # {plan: raw bytes} for the spans that were read, the caller falls back
+        # to the regular request path for the rest.
+        if self.breaker is not None and not self._breaker_allow():
+            return {}
+        if not (self.connected() or self.connect()):
+            return {}
+
+        sock = self.client.socket
+        # small back to back requests must not wait for each other's ACKs
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        instrument = self.instrument
+        queue = collections.deque(p for p in plans if p.rtype == registerType.HOLDING)
+        pending = {}
         results = {}
-        offset = addr_min
-        length = addr_max - addr_min
+        end = time.monotonic() + self.timeout * max(len(queue), 1)
+
+        if deadline is not None:
+            end = min(end, deadline)
 
         try:
-            if rtype == registerType.INPUT:
-                data = self._read_input_registers(v_slave, offset, length)
-            elif rtype == registerType.HOLDING:
-                data = self._read_holding_registers(v_slave, offset, length)
+            while queue or pending:
+                while queue and len(pending) < self.pipeline:
+                    plan = queue.popleft()
+                    self._transaction = self._transaction % 0xffff + 1
+                    sock.sendall(READ_REQUEST.pack(self._transaction, 0, 6, plan.slave, 3, plan.address, plan.length))
+                    pending[self._transaction] = (plan, time.perf_counter())
+
+                transaction, protocol, length, unit = MBAP_HEADER.unpack(self._recv_exactly(sock, MBAP_HEADER.size, end))
+
+                # the length counts the unit ID, a PDU holds at least a function code and one byte
+                if length < 2:
+                    raise ConnectionError(f"malformed response frame (length {length})")
+
+                pdu = self._recv_exactly(sock, length - 1, end)
+
+                if transaction not in pending:
+                    continue
+
+                plan, start = pending.pop(transaction)
+
+                if pdu[0] == 3 and len(pdu) == plan.length * 2 + 2 and pdu[1] == plan.length * 2:
+                    outcome = "ok"
+                    results[plan] = bytes(pdu[2:])
+                else:
+                    outcome = "exception" if pdu[0] & 0x80 else "short"
+
+                if instrument is not None:
+                    instrument.on_request(self, RequestEvent(3, plan.slave, plan.address, plan.length, time.perf_counter() - start, outcome, 12, length + 6))
+        except (OSError, struct.error):
+            # late responses would confuse the next request, start afresh
+            self._close()
+
+            if instrument is not None:
+                for plan, start in pending.values():
+                    instrument.on_request(self, RequestEvent(3, plan.slave, plan.address, plan.length, time.perf_counter() - start, "timeout", 12, 0))
+
+        if self.breaker is not None and results:
+            self.breaker.success()
+
+        return results
+
+    def _decode_changes(self, plan, data, deadbands):
+        # Compare the raw span with the previous poll first: an unchanged span is
+        # not decoded at all. Changed fields are compared against the value last
+        # reported, so a slow drift still surfaces once it exceeds the deadband.
+        previous = self._previous.get(plan)
+
+        if previous is not None and previous[0] == data:
+            return {}
+
+        values = self._decode(plan, data)
+
+        if previous is None:
+            self._previous[plan] = [data, values]
+            return values
+
+        reported = previous[1]
+        previous[0] = data
+        changes = {}
+
+        for k, v in values.items():
+            old = reported[k]
+
+            if v == old or (v != v and old != old):
+                continue
+            if k in deadbands and v == v and old == old and abs(v - old) <= deadbands[k]:
+                continue
+
+            changes[k] = reported[k] = v
+
+        return changes
+
+    def _plan_batches(self, values):
+        # Group by slave and register type, then coalesce (nearly) adjacent registers
+        # into as few requests as possible without exceeding the Modbus PDU limit.
+        batches = []
+        slaves = {}
+
+        for k, v in sorted(values.items(), key=lambda item: (item[1][0], item[1][3].value, item[1][1])):
+            slaves.setdefault((v[0], v[3]), []).append((k, v))
+
+        for slave, registers in slaves.items():
+            batch = {}
+            batch_start = batch_end = None
+
+            for k, v in registers:
+                address, length = v[1], v[2]
+
+                if batch and (
+                    address - batch_end > self.max_gap
+                    or max(batch_end, address + length) - batch_start > MAX_READ_REGISTERS
+                ):
+                    batches.append(batch)
+                    batch = {}
+
+                if not batch:
+                    batch_start = address
+                    batch_end = address
+
+                batch[k] = v
+                batch_end = max(batch_end, address + length)
+
+            if batch:
+                batches.append(batch)
+
+        return batches
+
+    def _socket(self, socket):
+        # None stands for the socket `registers` is written for
+        if socket is None or socket == self.socket_slave:
+            return None
+        if self.socket_slave is None:
+            raise NotImplementedError(f"{self.model} has no socket registers")
+        if not 1 <= socket <= MAX_SLAVE_ID:
+            raise ValueError(f"Invalid socket {socket}, sockets are slave IDs 1 to {MAX_SLAVE_ID}")
+        if self._nr_of_sockets is not None and socket > self._nr_of_sockets:
+            raise ValueError(f"Invalid socket {socket}, {self.host} has {self._nr_of_sockets} sockets")
+
+        return socket
+
+    def _registers_for(self, socket):
+        if socket is None:
+            return self.registers
+
+        return self.register_table.socket_registers(self.socket_slave, socket)
+
+    def _compiled_plans(self, keys, socket):
+        # Plans only depend on the register map, max_gap and word order, so they
+        # are shared by every instance of the class.
+        plan_key = (keys, socket, self.max_gap, self.wordorder)
+        plans = self.register_table.plans.get(plan_key)
+
+        if plans is None:
+            registers = self._registers_for(socket)
+            plans = [DecodePlan(batch, self.wordorder) for batch in self._plan_batches({k: registers[k] for k in keys})]
+            self.register_table.plans[plan_key] = plans
+
+        return plans
+
+    def _batches(self, rtype, socket=None):
+        return self._compiled_plans(self.register_table.by_rtype.get(rtype, ()), socket)
+
+    def _batches_for(self, keys, socket=None):
+        return self._compiled_plans(frozenset(keys), socket)
+
+    def _resolve_keys(self, keys):
+        if isinstance(keys, str):
+            keys = (keys,)
+
+        resolved = {}
+
+        for key in keys:
+            if key in self.register_table.groups:
+                resolved.update(dict.fromkeys(self.register_table.groups[key]))
+            elif key in self.registers:
+                resolved[key] = None
             else:
-                raise NotImplementedError(rtype)
+                raise KeyError(key)
 
-            if not data:
-                return results
+        return tuple(resolved)
 
-            for k, v in values.items():
-                slave, address, length, rtype, dtype, vtype, label, fmt, batch = v
+    def _read_spans(self, plans, deadline=None):
+        # Returns {plan: raw bytes} for the spans that could be read, pipelined
+        # where possible, one request at a time for the rest.
+        spans = {}
 
-                if address > offset:
-                    skip_bytes = address - offset
-                    offset += skip_bytes
-                    data.skip_bytes(skip_bytes * 2)
+        if self.pipeline > 1 and len(plans) > 1:
+            spans = self._read_pipelined(plans, deadline)
 
-                results[k] = self._decode_value(data, length, dtype, vtype)
-                offset += length
-                #print(k, results[k])
-        except NotImplementedError:
-            raise
+        for plan in plans:
+            if plan not in spans:
+                data = self._read_raw(plan, plan.rtype, deadline)
+
+                if data is not None:
+                    spans[plan] = data
+
+        return spans
+
+    def _read_plans(self, plans, delta=False, deadbands=None, cache=True):
+        # One retry budget covers the whole cycle, not every request in it
+        spans = self._read_spans(plans, self.retry_policy.deadline())
+        results = {}
+
+        for plan in plans:
+            data = spans.get(plan)
+
+            if data is None:
+                continue
+
+            if delta:
+                results.update(self._decode_changes(plan, data, deadbands or {}))
+            else:
+                results.update(self._decode(plan, data))
+
+        if self.cache and cache:
+            self._cache_put(results)
 
         return results
 
@@ -270,246 +1014,520 @@ class AlfenEve:
         except NotImplementedError:
             raise
 
+    def _plan_writes(self, values):
+        # Registers that follow each other without a hole on the same slave are
+        # written in one request. Requests keep the order the caller gave.
+        order = {k: i for i, k in enumerate(values)}
+        runs = []
+
+        for k in sorted(values, key=lambda k: self.registers[k][:2]):
+            slave, address, length, rtype, dtype, vtype, label, fmt, batch = self.registers[k]
+
+            if rtype != registerType.HOLDING:
+                raise NotImplementedError(rtype)
+
+            words = self._encode_value(values[k], dtype)
+            run = runs[-1] if runs else None
+
+            if run and run[0] == slave and run[1] + len(run[2]) == address and len(run[2]) + len(words) <= MAX_WRITE_REGISTERS:
+                run[2].extend(words)
+                run[3].append(k)
+            else:
+                runs.append([slave, address, list(words), [k]])
+
+        return sorted(runs, key=lambda run: min(order[k] for k in run[3]))
+
+    def _session_begin(self):
+        # Persistent sessions reuse the open socket, reconnecting only when
+        # the charger (or the idle timer) dropped it. With the circuit breaker
+        # open there is no point in even connecting.
+        if self.breaker is not None and self.breaker.is_open():
+            raise BreakerOpenException(f"{self.host}:{self.port}: circuit breaker open")
+
+        with self._session_lock:
+            self._session_users += 1
+
+        if self.persistent and self.connected():
+            return True
+
+        return self.connect()
+
+    def _session_end(self, failed=False):
+        with self._session_lock:
+            self._session_users -= 1
+            self._last_used = time.monotonic()
+
+            if self.persistent and not failed:
+                if self._idle_timer is None and self.idle_timeout is not None:
+                    self._schedule_idle_close(self.idle_timeout)
+                return
+
+        self.disconnect()
+
+    def _schedule_idle_close(self, delay):
+        self._idle_timer = threading.Timer(delay, self._close_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def _close_idle(self):
+        with self._session_lock:
+            self._idle_timer = None
+            remaining = self.idle_timeout - (time.monotonic() - self._last_used)
+
+            if self._session_users or remaining > 0:
+                self._schedule_idle_close(max(remaining, 0.1))
+                return
+
+            # still under the lock, so a session can't begin on the socket being closed
+            self._close()
+
+    def _cache_get(self, key):
+        entry = self._cache.get(key)
+
+        if entry is not None and entry[0] > time.monotonic():
+            self.cache_hits += 1
+            return entry
+        self.cache_misses += 1
+
+        return None
+
+    def _cache_put(self, values):
+        now = time.monotonic()
+
+        for k, v in values.items():
+            ttl = self.cache_ttl[self.register_classes.get(k, registerClass.MEASUREMENT)]
+
+            if ttl > 0 and v is not False:
+                self._cache[k] = (now + ttl, v)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
+
     def connect(self):
-        return self.client.connect()
+        if self.instrument is None:
+            return self.client.connect()
+
+        start = time.perf_counter()
+        connected = self.client.connect()
+        self.instrument.on_connect(self, connected, time.perf_counter() - start)
+
+        return connected
 
     def disconnect(self):
+        with self._session_lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+
+        self._close()
+
+    def _close(self):
         self.client.close()
 
+        if self.instrument is not None:
+            self.instrument.on_disconnect(self)
+
     def connected(self):
         return self.client.is_socket_open()
 
-    def read(self, key):
+    def read(self, key, socket=None):
         if key not in self.registers:
             raise KeyError(key)
 
-        return {key: self._read(self.registers[key])}
+        # the cache only holds values of the default socket
+        socket = self._socket(socket)
+        cache = self.cache and socket is None
+
+        if cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                return {key: cached[1]}
+
+        result = {key: self._read(self._registers_for(socket)[key])}
+
+        if cache:
+            self._cache_put(result)
+
+        return result
 
-    def write(self, key, data):
+    def write(self, key, data, socket=None):
         if key not in self.registers:
             raise KeyError(key)
 
-        return self._write(self.registers[key], data)
+        socket = self._socket(socket)
+        if socket is None:
+            self.invalidate(key)
 
-    def read_all(self, rtype=registerType.HOLDING):
-        registers = {k: v for k, v in self.registers.items() if (v[3] == rtype)}
-        results = {}
+        return self._write(self._registers_for(socket)[key], data)
 
-        for batch in range(1, len(registers)):
-            register_batch = {k: v for k, v in registers.items() if (v[8] == batch)}
+    def write_many(self, values):
+        """Write {register: value} in as few requests as possible, returns the responses."""
+        for key in values:
+            if key not in self.registers:
+                raise KeyError(key)
 
-            if not register_batch:
-                break
+            self.invalidate(key)
 
-            results.update(self._read_all(register_batch, rtype))
+        return [
+            self._write_holding_register(slave, address, words)
+            for slave, address, words, keys in self._plan_writes(values)
+        ]
 
-        return results
+    def read_many(self, keys, delta=False, deadbands=None, socket=None):
+        """Read the given registers and/or register groups in as few requests as possible.
+
+        With delta=True only the registers that changed since the previous delta
+        read are returned (all of them the first time). deadbands maps register
+        names to the absolute change a value must exceed to be reported.
+        """
+        socket = self._socket(socket)
+        return self._read_plans(self._batches_for(self._resolve_keys(keys), socket), delta, deadbands, socket is None)
+
+    def read_all(self, rtype=registerType.HOLDING, delta=False, deadbands=None, socket=None):
+        socket = self._socket(socket)
+        return self._read_plans(self._batches(rtype, socket), delta, deadbands, socket is None)
+
+    def _socket_keys(self, rtype):
+        return self.register_table.keys(self.socket_slave, rtype)
+
+    def nr_of_sockets(self):
+        """Number of sockets the charger reports, read once."""
+        if self._nr_of_sockets is None:
+            if self.socket_slave is None:
+                return 0
+
+            sockets = self.read("nr_of_sockets")["nr_of_sockets"]
+            if not sockets:
+                return 1
+
+            self._nr_of_sockets = sockets
+
+        return self._nr_of_sockets
+
+    def read_sockets(self, sockets=None, rtype=registerType.HOLDING, delta=False, deadbands=None):
+        """Read the socket registers of every socket (default: nr_of_sockets()), returns {socket: values}.
+
+        All sockets are read over this charger's one connection.
+        """
+        keys = self._socket_keys(rtype)
+
+        if sockets is None:
+            sockets = range(1, self.nr_of_sockets() + 1)
+
+        return {
+            socket: self._read_plans(self._batches_for(keys, self._socket(socket)), delta, deadbands, self._socket(socket) is None)
+            for socket in sockets
+        }
+
+    def _stream_keys(self, keys):
+        return self._resolve_keys(keys) if keys else tuple(self.registers)
+
+    def stream(self, keys=None, interval=1, count=None):
+        """Poll keys (default: all registers) every interval seconds and yield a Sample per poll.
+
+        Polls are scheduled on the monotonic clock, so request latency doesn't make
+        the schedule drift. A poll that overruns its slot skips the missed slots
+        rather than polling back-to-back, and reports them in the next Sample.
+        """
+        keys = self._stream_keys(keys)
+        plans = self._batches_for(keys)
+        next_poll = time.monotonic()
+        missed = 0
+        polls = 0
+
+        while count is None or polls < count:
+            timestamp = time.time()
+            results = self._read_plans(plans)
+            yield Sample(timestamp, keys, tuple(map(results.get, keys)), missed)
+            polls += 1
+
+            next_poll += interval
+            now = time.monotonic()
+            missed = 0
+
+            if now > next_poll:
+                missed = int((now - next_poll) // interval) + 1
+                next_poll += missed * interval
+
+            time.sleep(max(next_poll - time.monotonic(), 0))
+
+
+def _register_group(registers, slave, start, end):
+    return tuple(k for k, v in registers.items() if v[0] == slave and start <= v[1] < end)
 
 
 class CarCharger(AlfenEve):
 
+    registers = {
+        # name, address, length, register, type, target type, description, unit, batch
+        "c_name": (0xc8, 0x64, 17, registerType.HOLDING, registerDataType.STRING, str, "ALF_1000", "", 1),
+        "c_manufacturer": (0xc8, 0x75, 5, registerType.HOLDING, registerDataType.STRING, str, "Alfen NV", "", 1),
+        "c_modbus_table_version": (0xc8, 0x7a, 1, registerType.HOLDING, registerDataType.INT16, int, "1", "", 1),
+        "c_firmware_version": (0xc8, 0x7b, 17, registerType.HOLDING, registerDataType.STRING, str, "3.4.0-2990", "", 1),
+        "c_platform_type": (0xc8, 0x8c, 17, registerType.HOLDING, registerDataType.STRING, str, "NG910", "", 1),
+        "c_station_serial_number": (0xc8, 0x9d, 11, registerType.HOLDING, registerDataType.STRING, str, "00000R000", "", 1),
+        "c_date_year": (0xc8, 0xa8, 1, registerType.HOLDING, registerDataType.INT16, int, "2019", "1yr", 1),
+        "c_date_month": (0xc8, 0xa9, 1, registerType.HOLDING, registerDataType.INT16, int, "03", "1mon", 1),
+        "c_date_day": (0xc8, 0xaa, 1, registerType.HOLDING, registerDataType.INT16, int, "11", "1d", 1),
+        "c_time_hour": (0xc8, 0xab, 1, registerType.HOLDING, registerDataType.INT16, int, "12", "1hr", 1),
+        "c_time_minute": (0xc8, 0xac, 1, registerType.HOLDING, registerDataType.INT16, int, "01", "1min", 1),
+        "c_time_second": (0xc8, 0xad, 1, registerType.HOLDING, registerDataType.INT16, int, "04", "1s", 1),
+        "c_uptime": (0xc8, 0xae, 4, registerType.HOLDING, registerDataType.UINT64, int, "100", "0.001s", 1),
+        "c_time_zone": (0xc8, 0xb2, 1, registerType.HOLDING, registerDataType.INT16, int, "Time zone offset to UTC in minutes", "1min", 1),
+
+        "station_active_max_current": (0xc8, 0x44c, 2, registerType.HOLDING, registerDataType.FLOAT32, int, "The Actual Max Current", "A", 2),
+        "temperature": (0xc8, 0x44e, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Board Temperature", "degrees Celsius", 2),
+        "ocpp_state": (0xc8, 0x450, 1, registerType.HOLDING, registerDataType.UINT16, int, "Back Office Connected", "", 2),
+        "nr_of_sockets": (0xc8, 0x451, 1, registerType.HOLDING, registerDataType.UINT16, int, "Number of Sockets", "", 2),
+
+        "meter_state": (0x1, 0x12c, 1, registerType.HOLDING, registerDataType.UINT16, int, "Bitmask with state", "", 3),
+        "meter_last_value_timestamp": (0x1, 0x12d, 4, registerType.HOLDING, registerDataType.UINT64, int, "Milliseconds since last received measurement", "0.001s", 3),
+        "meter_type": (0x1, 0x131, 1, registerType.HOLDING, registerDataType.UINT16, int, "0:RTU, 1:TCP/IP, 2:UDP, 3:P1, 4:other", "", 3),
+
+        "voltage_phase_L1N": (0x1, 0x132, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L1N", "V", 4),
+        "voltage_phase_L2N": (
+        0x1, 0x134, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L2N", "V", 4),
+        "voltage_phase_L3N": (
+        0x1, 0x136, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L3N", "V", 4),
+        "voltage_phase_L1L2": (
+        0x1, 0x138, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L1L2", "V", 4),
+        "voltage_phase_L2L3": (
+            0x1, 0x13a, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L2L3", "V", 4),
+        "voltage_phase_L3L1": (
+            0x1, 0x13c, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L3L1", "V", 4),
+        "current_N": (
+            0x1, 0x13e, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Current through N", "A", 4),
+        "current_phase_L1": (
+            0x1, 0x140, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Current Phase L1", "A", 4),
+        "current_phase_L2": (
+            0x1, 0x142, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Current Phase L2", "A", 4),
+        "current_phase_L3": (
+            0x1, 0x144, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Current Phase L3", "A", 4),
+        "current_sum": (
+            0x1, 0x146, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Current Sum", "A", 4),
+
+        "power_factor_phase_L1": (
+            0x1, 0x148, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Power Factor Phase L1", "", 5),
+        "power_factor_phase_L2": (
+            0x1, 0x14a, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Power Factor Phase L2", "", 5),
+        "power_factor_phase_L3": (
+            0x1, 0x14c, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Power Factor Phase L3", "", 5),
+        "power_factor_sum": (
+            0x1, 0x14e, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Power Factor Sum", "", 5),
+        "frequency": (
+            0x1, 0x150, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Frequency", "Hz", 5),
+
+        "real_power_phase_L1": (
+            0x1, 0x152, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Real Power Phase L1", "W", 5),
+        "real_power_phase_L2": (
+            0x1, 0x154, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Real Power Phase L2", "W", 5),
+        "real_power_phase_L3": (
+            0x1, 0x156, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Real Power Phase L3", "W", 5),
+        "real_power_sum": (
+            0x1, 0x158, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Real Power Sum", "W", 5),
+
+        "apparent_power_phase_L1": (
+            0x1, 0x15a, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Apparent Power Phase L1", "VA", 5),
+        "apparent_power_phase_L2": (
+            0x1, 0x15c, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Apparent Power Phase L2", "VA", 5),
+        "apparent_power_phase_L3": (
+            0x1, 0x15e, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Apparent Power Phase L3", "VA", 5),
+        "apparent_power_sum": (
+            0x1, 0x160, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Apparent Power Sum", "VA", 5),
+
+        "reactive_power_phase_L1": (
+            0x1, 0x162, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Reactive Power Phase L1", "VAr", 5),
+        "reactive_power_phase_L2": (
+            0x1, 0x164, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Reactive Power Phase L2", "VAr", 5),
+        "reactive_power_phase_L3": (
+            0x1, 0x166, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Reactive Power Phase L3", "VAr", 5),
+        "reactive_power_sum": (
+            0x1, 0x168, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Reactive Power Sum", "VAr", 5),
+
+        "real_energy_delivered_phase_L1": (
+            0x1, 0x16a, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Delivered Phase L1", "Wh", 6),
+        "real_energy_delivered_phase_L2": (
+            0x1, 0x16e, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Delivered Phase L2", "Wh", 6),
+        "real_energy_delivered_phase_L3": (
+            0x1, 0x172, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Delivered Phase L3", "Wh", 6),
+        "real_energy_delivered_sum": (
+            0x1, 0x176, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Delivered Sum", "Wh", 6),
+
+        "real_energy_consumed_phase_L1": (
+            0x1, 0x17a, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Consumed Phase L1", "Wh", 6),
+        "real_energy_consumed_phase_L2": (
+            0x1, 0x17e, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Consumed Phase L2", "Wh", 6),
+        "real_energy_consumed_phase_L3": (
+            0x1, 0x182, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Consumed Phase L3", "Wh", 6),
+        "real_energy_consumed_sum": (
+            0x1, 0x186, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Consumed Sum", "Wh", 6),
+
+        "apparent_energy_phase_L1": (
+            0x1, 0x18a, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Apparent Energy Phase L1", "VAh", 6),
+        "apparent_energy_phase_L2": (
+            0x1, 0x18e, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Apparent Energy Phase L2", "VAh", 6),
+        "apparent_energy_phase_L3": (
+            0x1, 0x192, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Apparent Energy Phase L3", "VAh", 6),
+        "apparent_energy_sum": (
+            0x1, 0x196, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Apparent Energy Sum", "VAh", 6),
+
+        "reactive_energy_phase_L1": (
+            0x1, 0x19a, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Reactive Energy Phase L1", "VArh", 6),
+        "reactive_energy_phase_L2": (
+            0x1, 0x19e, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Reactive Energy Phase L2", "VArh", 6),
+        "reactive_energy_phase_L3": (
+            0x1, 0x1a2, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Reactive Energy Phase L3", "VArh", 6),
+        "reactive_energy_sum": (
+            0x1, 0x1a6, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Reactive Energy Sum", "VArh", 6),
+
+        "availability": (
+            0x1, 0x4b0, 1, registerType.HOLDING, registerDataType.UINT16, int, "1: Operative; 0: Inoperative", "",
+            7),
+        "mode_3_state": (0x1, 0x4b1, 5, registerType.HOLDING, registerDataType.STRING, str, "61851 states",
+                         "", 7),
+        "actual_applied_max_current": (
+            0x1, 0x4b6, 2, registerType.HOLDING, registerDataType.FLOAT32, float,
+            "Actual Applied Max Current for Socket", "A", 7),
+        "modbus_slave_max_current_valid_time": (
+            0x1, 0x4b8, 2, registerType.HOLDING, registerDataType.UINT32, int,
+            "Remaining time before fallback to safe current", "1s", 7),
+        "modbus_slave_max_current": (
+            0x1, 0x4ba, 2, registerType.HOLDING, registerDataType.FLOAT32, float,
+            "Modbus Slave Max Current", "A", 7),
+        "active_load_balancing_safe_current": (
+            0x1, 0x4bc, 2, registerType.HOLDING, registerDataType.FLOAT32, float,
+            "Active Load Balancing Safe Current", "A", 7),
+        "modbus_slave_received_setpoint_accounted_for": (
+            0x1, 0x4be, 1, registerType.HOLDING, registerDataType.UINT16, int,
+            "Modbus Slave Received Setpoint Accounted For", "", 7),
+        "charge_using_1_or_3_phases": (
+            0x1, 0x4bf, 1, registerType.HOLDING, registerDataType.UINT16, int,
+            "Phases used for charging", "phases", 7),
+
+        "scn_name": (0xc8, 0x578, 4, registerType.HOLDING, registerDataType.STRING, str, "", "", 8),
+        "scn_sockets": (0xc8, 0x57c, 1, registerType.HOLDING, registerDataType.UINT16, int, "", "1A", 8),
+        "scn_total_consumption_phase_l1": (0xc8, 0x57d, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
+        "scn_total_consumption_phase_l2": (0xc8, 0x57f, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
+        "scn_total_consumption_phase_l3": (0xc8, 0x581, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
+        "scn_actual_max_current_phase_l1": (0xc8, 0x583, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
+        "scn_actual_max_current_phase_l2": (0xc8, 0x585, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
+        "scn_actual_max_current_phase_l3": (0xc8, 0x587, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
+        "scn_max_current_phase_l1": (0xc8, 0x589, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 9),
+        "scn_max_current_phase_l2": (0xc8, 0x58b, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 9),
+        "scn_max_current_phase_l3": (0xc8, 0x58d, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 9),
+        "remaining_valid_time_max_current_phase_l1": (0xc8, 0x58f, 2, registerType.HOLDING, registerDataType.UINT32, int, "Max current valid time", "1s", 9),
+        "remaining_valid_time_max_current_phase_l2": (0xc8, 0x591, 2, registerType.HOLDING, registerDataType.UINT32, int, "Max current valid time", "1s", 9),
+        "remaining_valid_time_max_current_phase_l3": (0xc8, 0x593, 2, registerType.HOLDING, registerDataType.UINT32, int, "Max current valid time", "1s", 9),
+        "scn_safe_current": (0xc8, 0x595, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Configured SCN safe current", "1A", 9),
+        "scn_modbus_slave_max_current_enable": (0xc8, 0x597, 1, registerType.HOLDING, registerDataType.UINT16, int, "1: Enabled; 0: Disabled", "1A",
+        9)
+
+    }
+
+    register_groups = {
+        "identity": _register_group(registers, 0xc8, 0x64, 0xc8),
+        "station": _register_group(registers, 0xc8, 0x44c, 0x4b0),
+        "meter": _register_group(registers, 0x1, 0x12c, 0x1f4),
+        "socket": _register_group(registers, 0x1, 0x4b0, 0x514),
+        "scn": _register_group(registers, 0xc8, 0x578, 0x5dc)
+    }
+
+    probe_register = "ocpp_state"
+    socket_slave = 0x1
+
+    register_classes = {
+        "c_name": registerClass.IDENTITY,
+        "c_manufacturer": registerClass.IDENTITY,
+        "c_modbus_table_version": registerClass.IDENTITY,
+        "c_firmware_version": registerClass.IDENTITY,
+        "c_platform_type": registerClass.IDENTITY,
+        "c_station_serial_number": registerClass.IDENTITY,
+        "nr_of_sockets": registerClass.IDENTITY,
+        "meter_type": registerClass.IDENTITY,
+        "scn_name": registerClass.IDENTITY,
+        "scn_sockets": registerClass.IDENTITY,
+
+        "modbus_slave_max_current": registerClass.SETPOINT,
+        "active_load_balancing_safe_current": registerClass.SETPOINT,
+        "modbus_slave_received_setpoint_accounted_for": registerClass.SETPOINT,
+        "charge_using_1_or_3_phases": registerClass.SETPOINT,
+        "scn_max_current_phase_l1": registerClass.SETPOINT,
+        "scn_max_current_phase_l2": registerClass.SETPOINT,
+        "scn_max_current_phase_l3": registerClass.SETPOINT,
+        "scn_safe_current": registerClass.SETPOINT,
+        "scn_modbus_slave_max_current_enable": registerClass.SETPOINT
+    }
+
     def __init__(self, *args, **kwargs):
         self.model = "Car Charger"
         self.wordorder = Endian.BIG
 
         super().__init__(*args, **kwargs)
 
-        self.registers = {
-            # name, address, length, register, type, target type, description, unit, batch
-            "c_name": (0xc8, 0x64, 17, registerType.HOLDING, registerDataType.STRING, str, "ALF_1000", "", 1),
-            "c_manufacturer": (0xc8, 0x75, 5, registerType.HOLDING, registerDataType.STRING, str, "Alfen NV", "", 1),
-            "c_modbus_table_version": (0xc8, 0x7a, 1, registerType.HOLDING, registerDataType.INT16, int, "1", "", 1),
-            "c_firmware_version": (0xc8, 0x7b, 17, registerType.HOLDING, registerDataType.STRING, str, "3.4.0-2990", "", 1),
-            "c_platform_type": (0xc8, 0x8c, 17, registerType.HOLDING, registerDataType.STRING, str, "NG910", "", 1),
-            "c_station_serial_number": (0xc8, 0x9d, 11, registerType.HOLDING, registerDataType.STRING, str, "00000R000", "", 1),
-            "c_date_year": (0xc8, 0xa8, 1, registerType.HOLDING, registerDataType.INT16, int, "2019", "1yr", 1),
-            "c_date_month": (0xc8, 0xa9, 1, registerType.HOLDING, registerDataType.INT16, int, "03", "1mon", 1),
-            "c_date_day": (0xc8, 0xaa, 1, registerType.HOLDING, registerDataType.INT16, int, "11", "1d", 1),
-            "c_time_hour": (0xc8, 0xab, 1, registerType.HOLDING, registerDataType.INT16, int, "12", "1hr", 1),
-            "c_time_minute": (0xc8, 0xac, 1, registerType.HOLDING, registerDataType.INT16, int, "01", "1min", 1),
-            "c_time_second": (0xc8, 0xad, 1, registerType.HOLDING, registerDataType.INT16, int, "04", "1s", 1),
-            "c_uptime": (0xc8, 0xae, 4, registerType.HOLDING, registerDataType.UINT64, int, "100", "0.001s", 1),
-            "c_time_zone": (0xc8, 0xb2, 1, registerType.HOLDING, registerDataType.INT16, int, "Time zone offset to UTC in minutes", "1min", 1),
-
-            "station_active_max_current": (0xc8, 0x44c, 2, registerType.HOLDING, registerDataType.FLOAT32, int, "The Actual Max Current", "A", 2),
-            "temperature": (0xc8, 0x44e, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Board Temperature", "degrees Celsius", 2),
-            "ocpp_state": (0xc8, 0x450, 1, registerType.HOLDING, registerDataType.UINT16, int, "Back Office Connected", "", 2),
-            "nr_of_sockets": (0xc8, 0x451, 1, registerType.HOLDING, registerDataType.UINT16, int, "Number of Sockets", "", 2),
-
-            "meter_state": (0x1, 0x12c, 1, registerType.HOLDING, registerDataType.UINT16, int, "Bitmask with state", "", 3),
-            "meter_last_value_timestamp": (0x1, 0x12d, 4, registerType.HOLDING, registerDataType.UINT64, int, "Milliseconds since last received measurement", "0.001s", 3),
-            "meter_type": (0x1, 0x131, 1, registerType.HOLDING, registerDataType.UINT16, int, "0:RTU, 1:TCP/IP, 2:UDP, 3:P1, 4:other", "", 3),
-
-            "voltage_phase_L1N": (0x1, 0x132, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L1N", "V", 4),
-            "voltage_phase_L2N": (
-            0x1, 0x134, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L2N", "V", 4),
-            "voltage_phase_L3N": (
-            0x1, 0x136, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L3N", "V", 4),
-            "voltage_phase_L1L2": (
-            0x1, 0x138, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L1L2", "V", 4),
-            "voltage_phase_L2L3": (
-                0x1, 0x13a, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L2L3", "V", 4),
-            "voltage_phase_L3L1": (
-                0x1, 0x13c, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Voltage Phase L3L1", "V", 4),
-            "current_N": (
-                0x1, 0x13e, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Current through N", "A", 4),
-            "current_phase_L1": (
-                0x1, 0x140, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Current Phase L1", "A", 4),
-            "current_phase_L2": (
-                0x1, 0x142, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Current Phase L2", "A", 4),
-            "current_phase_L3": (
-                0x1, 0x144, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Current Phase L3", "A", 4),
-            "current_sum": (
-                0x1, 0x146, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Current Sum", "A", 4),
-
-            "power_factor_phase_L1": (
-                0x1, 0x148, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Power Factor Phase L1", "", 5),
-            "power_factor_phase_L2": (
-                0x1, 0x14a, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Power Factor Phase L2", "", 5),
-            "power_factor_phase_L3": (
-                0x1, 0x14c, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Power Factor Phase L3", "", 5),
-            "power_factor_sum": (
-                0x1, 0x14e, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Power Factor Sum", "", 5),
-            "frequency": (
-                0x1, 0x150, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Frequency", "Hz", 5),
-
-            "real_power_phase_L1": (
-                0x1, 0x152, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Real Power Phase L1", "W", 5),
-            "real_power_phase_L2": (
-                0x1, 0x154, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Real Power Phase L2", "W", 5),
-            "real_power_phase_L3": (
-                0x1, 0x156, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Real Power Phase L3", "W", 5),
-            "real_power_sum": (
-                0x1, 0x158, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Real Power Sum", "W", 5),
-
-            "apparent_power_phase_L1": (
-                0x1, 0x15a, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Apparent Power Phase L1", "VA", 5),
-            "apparent_power_phase_L2": (
-                0x1, 0x15c, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Apparent Power Phase L2", "VA", 5),
-            "apparent_power_phase_L3": (
-                0x1, 0x15e, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Apparent Power Phase L3", "VA", 5),
-            "apparent_power_sum": (
-                0x1, 0x160, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Apparent Power Sum", "VA", 5),
-
-            "reactive_power_phase_L1": (
-                0x1, 0x162, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Reactive Power Phase L1", "VAr", 5),
-            "reactive_power_phase_L2": (
-                0x1, 0x164, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Reactive Power Phase L2", "VAr", 5),
-            "reactive_power_phase_L3": (
-                0x1, 0x166, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Reactive Power Phase L3", "VAr", 5),
-            "reactive_power_sum": (
-                0x1, 0x168, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Reactive Power Sum", "VAr", 5),
-
-            "real_energy_delivered_phase_L1": (
-                0x1, 0x16a, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Delivered Phase L1", "Wh", 6),
-            "real_energy_delivered_phase_L2": (
-                0x1, 0x16e, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Delivered Phase L2", "Wh", 6),
-            "real_energy_delivered_phase_L3": (
-                0x1, 0x172, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Delivered Phase L3", "Wh", 6),
-            "real_energy_delivered_sum": (
-                0x1, 0x176, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Delivered Sum", "Wh", 6),
-
-            "real_energy_consumed_phase_L1": (
-                0x1, 0x17a, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Consumed Phase L1", "Wh", 6),
-            "real_energy_consumed_phase_L2": (
-                0x1, 0x17e, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Consumed Phase L2", "Wh", 6),
-            "real_energy_consumed_phase_L3": (
-                0x1, 0x182, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Consumed Phase L3", "Wh", 6),
-            "real_energy_consumed_sum": (
-                0x1, 0x186, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Real Energy Consumed Sum", "Wh", 6),
-
-            "apparent_energy_phase_L1": (
-                0x1, 0x18a, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Apparent Energy Phase L1", "VAh", 6),
-            "apparent_energy_phase_L2": (
-                0x1, 0x18e, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Apparent Energy Phase L2", "VAh", 6),
-            "apparent_energy_phase_L3": (
-                0x1, 0x192, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Apparent Energy Phase L3", "VAh", 6),
-            "apparent_energy_sum": (
-                0x1, 0x196, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Apparent Energy Sum", "VAh", 6),
-
-            "reactive_energy_phase_L1": (
-                0x1, 0x19a, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Reactive Energy Phase L1", "VArh", 6),
-            "reactive_energy_phase_L2": (
-                0x1, 0x19e, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Reactive Energy Phase L2", "VArh", 6),
-            "reactive_energy_phase_L3": (
-                0x1, 0x1a2, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Reactive Energy Phase L3", "VArh", 6),
-            "reactive_energy_sum": (
-                0x1, 0x1a6, 4, registerType.HOLDING, registerDataType.FLOAT64, float, "Reactive Energy Sum", "VArh", 6),
-
-            "availability": (
-                0x1, 0x4b0, 1, registerType.HOLDING, registerDataType.UINT16, int, "1: Operative; 0: Inoperative", "",
-                7),
-            "mode_3_state": (0x1, 0x4b1, 5, registerType.HOLDING, registerDataType.STRING, str, "61851 states",
-                             "", 7),
-            "actual_applied_max_current": (
-                0x1, 0x4b6, 2, registerType.HOLDING, registerDataType.FLOAT32, float,
-                "Actual Applied Max Current for Socket", "A", 7),
-            "modbus_slave_max_current_valid_time": (
-                0x1, 0x4b8, 2, registerType.HOLDING, registerDataType.UINT32, int,
-                "Remaining time before fallback to safe current", "1s", 7),
-            "modbus_slave_max_current": (
-                0x1, 0x4ba, 2, registerType.HOLDING, registerDataType.FLOAT32, float,
-                "Modbus Slave Max Current", "A", 7),
-            "active_load_balancing_safe_current": (
-                0x1, 0x4bc, 2, registerType.HOLDING, registerDataType.FLOAT32, float,
-                "Active Load Balancing Safe Current", "A", 7),
-            "modbus_slave_received_setpoint_accounted_for": (
-                0x1, 0x4be, 1, registerType.HOLDING, registerDataType.UINT16, int,
-                "Modbus Slave Received Setpoint Accounted For", "", 7),
-            "charge_using_1_or_3_phases": (
-                0x1, 0x4bf, 1, registerType.HOLDING, registerDataType.UINT16, int,
-                "Phases used for charging", "phases", 7),
-
-            "scn_name": (0xc8, 0x578, 4, registerType.HOLDING, registerDataType.STRING, str, "", "", 8),
-            "scn_sockets": (0xc8, 0x57c, 1, registerType.HOLDING, registerDataType.UINT16, int, "", "1A", 8),
-            "scn_total_consumption_phase_l1": (0xc8, 0x57d, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
-            "scn_total_consumption_phase_l2": (0xc8, 0x57f, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
-            "scn_total_consumption_phase_l3": (0xc8, 0x581, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
-            "scn_actual_max_current_phase_l1": (0xc8, 0x583, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
-            "scn_actual_max_current_phase_l2": (0xc8, 0x585, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
-            "scn_actual_max_current_phase_l3": (0xc8, 0x587, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 8),
-            "scn_max_current_phase_l1": (0xc8, 0x589, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 9),
-            "scn_max_current_phase_l2": (0xc8, 0x58b, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 9),
-            "scn_max_current_phase_l3": (0xc8, 0x58d, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "", "1A", 9),
-            "remaining_valid_time_max_current_phase_l1": (0xc8, 0x58f, 2, registerType.HOLDING, registerDataType.UINT32, int, "Max current valid time", "1s", 9),
-            "remaining_valid_time_max_current_phase_l2": (0xc8, 0x591, 2, registerType.HOLDING, registerDataType.UINT32, int, "Max current valid time", "1s", 9),
-            "remaining_valid_time_max_current_phase_l3": (0xc8, 0x593, 2, registerType.HOLDING, registerDataType.UINT32, int, "Max current valid time", "1s", 9),
-            "scn_safe_current": (0xc8, 0x595, 2, registerType.HOLDING, registerDataType.FLOAT32, float, "Configured SCN safe current", "1A", 9),
-            "scn_modbus_slave_max_current_enable": (0xc8, 0x597, 1, registerType.HOLDING, registerDataType.UINT16, int, "1: Enabled; 0: Disabled", "1A",
-            9)
+    def read_with_retry(self, key):
+        deadline = self.retry_policy.deadline()
+        attempt = 0
 
-        }
+        while True:
+            self._session_begin()
 
-    def read_with_retry(self, key):
-        for attempt in range(1, self.retries + 1):
             try:
-                self.connect()
                 value = self.read(key)
-                self.disconnect()
+                self._session_end()
                 return value
             except Exception as e:
-                if attempt < self.retries:
-                    time.sleep(self.timeout)
-                else:
-                    syslog.syslog(f"Failed to read {key} after {self.retries} attempts: {e}")
+                self._session_end(failed=True)
+
+                attempt += 1
+                outcome = _exception_outcome(e)
+                delay = self.retry_policy.delay(attempt, outcome, deadline)
+
+                if delay is None:
+                    syslog.syslog(f"Failed to read {key} after {attempt} attempts: {e}")
                     raise
-        return False
+                if self.instrument is not None:
+                    self.instrument.on_retry(self, attempt, outcome)
+
+                time.sleep(delay)
 
     def write_with_retry(self, key: str, value: int) -> bool:
         """Write a value to the car_charger with retries."""
-        for attempt in range(1, self.retries + 1):
+        deadline = self.retry_policy.deadline()
+        attempt = 0
+
+        while True:
+            self._session_begin()
+
             try:
-                self.connect()
-                self.write(key, value)
-                self.disconnect()
-                return True
+                result = self.write(key, value)
             except Exception as e:
-                if attempt < self.retries:
-                    time.sleep(self.timeout)
-                else:
-                    syslog.syslog(f"Failed to write {key} after {self.retries} attempts: {e}")
-                    raise
-        return False
+                self._session_end(failed=True)
+                result = error = e
+                outcome = _exception_outcome(e)
+            else:
+                error = None
+                # a timeout or exception response comes back as the result
+                outcome = _write_outcome(result)
+                self._session_end(failed=outcome != "ok")
+
+                if outcome == "ok":
+                    return True
+
+            attempt += 1
+            delay = self.retry_policy.delay(attempt, outcome, deadline)
+
+            if delay is None:
+                syslog.syslog(f"Failed to write {key} after {attempt} attempts: {result}")
+                if error is not None:
+                    raise error
+                return False
+            if self.instrument is not None:
+                self.instrument.on_retry(self, attempt, outcome)
+
+            time.sleep(delay)
 
     def get_status(self):
         mode_3_state = self.read_with_retry("mode_3_state")
@@ -559,22 +1577,111 @@ class CarCharger(AlfenEve):
     def set_current(self, current):
         self.write_with_retry('modbus_slave_max_current', current)
 
+    def wait_for_setpoint(self, timeout=SETPOINT_TIMEOUT, interval=SETPOINT_POLL_INTERVAL):
+        """Poll until the charger reports the last setpoint as accounted for, at most `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+
+        while True:
+            accounted = self.read("modbus_slave_received_setpoint_accounted_for")["modbus_slave_received_setpoint_accounted_for"]
+
+            if accounted == 1:
+                return True
+            if time.monotonic() + interval > deadline:
+                return False
+
+            time.sleep(interval)
+
+    def _write_run_with_retry(self, slave, address, words, keys):
+        # One planned write with the retry loop of write_with_retry, over the
+        # session the caller holds open.
+        deadline = self.retry_policy.deadline()
+        attempt = 0
+
+        while True:
+            try:
+                result = self._write_holding_register(slave, address, words)
+                outcome = _write_outcome(result)
+            except ModbusException as e:
+                result = e
+                outcome = _exception_outcome(e)
+
+            if outcome == "ok":
+                return True
+
+            attempt += 1
+            delay = self.retry_policy.delay(attempt, outcome, deadline)
+
+            if delay is None:
+                syslog.syslog(f"Failed to write {', '.join(keys)} after {attempt} attempts: {result}")
+                return False
+            if self.instrument is not None:
+                self.instrument.on_retry(self, attempt, outcome)
+
+            time.sleep(delay)
+
+    def _write_profile(self, values):
+        for key in values:
+            self.invalidate(key)
+
+        for slave, address, words, keys in self._plan_writes(values):
+            if not self._write_run_with_retry(slave, address, words, keys):
+                return False
+
+        if not self.wait_for_setpoint():
+            syslog.syslog(f"Setpoint {values} not accounted for within {SETPOINT_TIMEOUT}s")
+
+        return True
+
     def set_charge_profile(self, phases, current):
-        status = self.get_status()
-        if (status == "Charging" or status == "Connected"):
-            current_phases = int(self.get_phases())
-            momentary_current = self.get_current()
-            syslog.syslog(f"Currently Charge Profile is: Phase(s): {current_phases}; Current: {momentary_current} A.")
-            syslog.syslog(f"Current Phase(s): {current_phases} versus Requested Phase(s): {phases}")
-            if current_phases != phases:
-                if status == "Charging":
-                    self.pause_charging()
-                    time.sleep(1)
-                self.switch_phase(phases)
-            self.set_current(current)
-            time.sleep(1)
-            phases = self.get_phases()
-            current = self.get_current()
-            syslog.syslog(f"Charge Profile Set: Phase(s): {phases}; Current: {current} A.")
-        else:
-            syslog.syslog(f"Car is not connected: {status}, so no changes in charge profile applied.")
\ No newline at end of file
+        PAUSE_CURRENT = 5
+        profile = ("mode_3_state", "charge_using_1_or_3_phases", "modbus_slave_max_current")
+
+        try:
+            self._session_begin()
+        except ModbusException as e:
+            syslog.syslog(f"Failed to set the charge profile: {e}")
+            return
+
+        failed = False
+
+        try:
+            values = self.read_many(profile)
+            # a small max_gap splits the profile over several spans, any of which can fail
+            if not values.get("mode_3_state") or any(values.get(k) is None or values.get(k) is False for k in profile):
+                syslog.syslog("Failed to read the charge profile, so no changes in charge profile applied.")
+                return
+
+            status = MODE_3_STATE_MAP[values["mode_3_state"]]
+            if (status == "Charging" or status == "Connected"):
+                current_phases = values["charge_using_1_or_3_phases"]
+                momentary_current = values["modbus_slave_max_current"]
+                syslog.syslog(f"Currently Charge Profile is: Phase(s): {current_phases}; Current: {momentary_current} A.")
+                syslog.syslog(f"Current Phase(s): {current_phases} versus Requested Phase(s): {phases}")
+
+                update = {"modbus_slave_max_current": current}
+
+                if current_phases != phases:
+                    if phases == 1 or phases == 3:
+                        if status == "Charging" and momentary_current > 5.5:
+                            syslog.syslog("Pausing...")
+                            if not self._write_profile({"modbus_slave_max_current": PAUSE_CURRENT}):
+                                return
+                        update = {"charge_using_1_or_3_phases": phases, **update}
+                    else:
+                        syslog.syslog(f"Invalid # of phases: {phases}...")
+
+                if not self._write_profile(update):
+                    return
+
+                values = self.read_many(profile[1:])
+                phases = values.get("charge_using_1_or_3_phases")
+                current = values.get("modbus_slave_max_current")
+                syslog.syslog(f"Charge Profile Set: Phase(s): {phases}; Current: {current} A.")
+            else:
+                syslog.syslog(f"Car is not connected: {status}, so no changes in charge profile applied.")
+        except ModbusException as e:
+            # say the charger dropped the connection while accounting for the setpoint
+            failed = True
+            syslog.syslog(f"Failed to set the charge profile: {e}")
+        finally:
+            self._session_end(failed=failed)
\ No newline at end of file
@@ -0,0 +1,160 @@
+# Polls a charger's register groups at intervals that follow what the charger is
+# doing. An idle charger only needs its socket state now and then, a charging
+# one needs power and currents every second. The activity is derived from
+# mode_3_state, availability and meter_state of the latest poll, and a change of
+# activity polls every group at once instead of waiting for their next slot.
+#
+#   poller = AdaptivePoller(car_charger)
+#   for sample in poller.stream():
+#       print(poller.activity, sample.values)
+
+import enum
+import math
+import time
+
+from . import Sample, MODE_3_STATE_MAP
+
+
+class chargerActivity(enum.Enum):
+    IDLE = 1
+    CONNECTED = 2
+    CHARGING = 3
+    UNAVAILABLE = 4
+
+
+# Seconds between polls of each group, None to never poll it again after the first
+POLL_INTERVALS = {
+    chargerActivity.IDLE: {"identity": 3600, "station": 300, "socket": 5, "power": 30, "energy": 30, "scn": 300},
+    chargerActivity.CONNECTED: {"identity": 3600, "station": 60, "socket": 2, "power": 10, "energy": 30, "scn": 30},
+    chargerActivity.CHARGING: {"identity": 3600, "station": 60, "socket": 1, "power": 1, "energy": 15, "scn": 15},
+    chargerActivity.UNAVAILABLE: {"identity": 3600, "station": 60, "socket": 30, "power": 300, "energy": 300, "scn": 300}
+}
+# Seconds before the groups of a failed poll are tried again
+POLL_RETRY = 5
+# meter_state bit set while the meter delivers fresh values
+METER_UPDATED = 0x2
+
+
+def _poll_groups(charger):
+    # The meter group is split in instantaneous values and the (much larger)
+    # energy counters, which don't need the same resolution.
+    groups = dict(charger.register_table.groups)
+    meter = groups.pop("meter", ())
+
+    if meter:
+        groups["power"] = tuple(k for k in meter if "energy" not in k)
+        groups["energy"] = tuple(k for k in meter if "energy" in k)
+
+    return groups
+
+
+class AdaptivePoller:
+
+    def __init__(self, charger, intervals=POLL_INTERVALS, retry=POLL_RETRY):
+        self.charger = charger
+        self.intervals = intervals
+        self.retry = retry
+        self.groups = _poll_groups(charger)
+        self.activity = None
+        self.values = {}
+
+        self.polls = 0
+        self.transitions = 0
+
+        # group: monotonic time of the last complete read, and of the next one due
+        self._polled = {}
+        self._due = dict.fromkeys(self.groups, 0.0)
+
+    def __repr__(self):
+        return f"AdaptivePoller({self.charger.host}: activity={self.activity}, polls={self.polls}, transitions={self.transitions})"
+
+    def classify(self, values):
+        """Activity of the charger given its latest register values."""
+        if values.get("availability") == 0:
+            return chargerActivity.UNAVAILABLE
+
+        state = MODE_3_STATE_MAP.get(values.get("mode_3_state"))
+
+        if state == "Charging":
+            return chargerActivity.CHARGING
+        if state in ("Connected", "Error"):
+            return chargerActivity.CONNECTED
+
+        return chargerActivity.IDLE
+
+    def interval(self, group):
+        activity = self.activity or chargerActivity.IDLE
+
+        # a meter that stopped updating has nothing new to read
+        if group in ("power", "energy"):
+            meter_state = self.values.get("meter_state")
+
+            if isinstance(meter_state, int) and not meter_state & METER_UPDATED:
+                activity = chargerActivity.UNAVAILABLE
+
+        return self.intervals[activity].get(group)
+
+    def remaining(self):
+        """Seconds until the next group is due, 0 if one is due now."""
+        return max(min(self._due.values(), default=math.inf) - time.monotonic(), 0)
+
+    def _read(self, groups):
+        keys = tuple(k for group in groups for k in self.groups[group])
+        values = self.charger.read_many(keys) if keys else {}
+        self.values.update(values)
+
+        return values, [group for group in groups if all(k in values for k in self.groups[group])]
+
+    def poll(self):
+        """Read the groups that are due, returns the values read (empty if none were due)."""
+        now = time.monotonic()
+        due = [group for group, at in self._due.items() if at <= now]
+
+        if not due:
+            return {}
+
+        values, polled = self._read(due)
+        activity = self.classify(self.values)
+
+        if activity != self.activity:
+            # a transition (say a car starting to charge) is not kept waiting
+            # for slots planned under the previous activity
+            if self.activity is not None:
+                self.transitions += 1
+                rest = [group for group in self.groups if group not in due and group != "identity"]
+                extra, extra_polled = self._read(rest)
+                values.update(extra)
+                due += rest
+                polled += extra_polled
+
+            self.activity = activity
+
+        for group in polled:
+            self._polled[group] = now
+
+        # intervals follow the current activity, including those of groups not read now
+        for group, at in self._polled.items():
+            interval = self.interval(group)
+            self._due[group] = math.inf if interval is None else at + interval
+
+        for group in due:
+            if group not in polled:
+                self._due[group] = now + self.retry
+
+        self.polls += 1
+
+        return values
+
+    def stream(self, count=None):
+        """Poll whenever a group is due and yield a Sample with the latest value of every register."""
+        polls = 0
+
+        while count is None or polls < count:
+            time.sleep(self.remaining())
+            timestamp = time.time()
+
+            if not self.poll():
+                continue
+
+            yield Sample(timestamp, tuple(self.values), tuple(self.values.values()), 0)
+            polls += 1
@@ -0,0 +1,563 @@
+# asyncio flavour of AlfenEve/CarCharger, built on pymodbus' AsyncModbusTcpClient.
+# The register table, request planning and decoding are shared with the blocking
+# classes, only the I/O is awaited instead.
+
+import asyncio
+import syslog
+import time
+
+from pymodbus.constants import Endian
+from pymodbus.exceptions import ModbusException
+from pymodbus.payload import BinaryPayloadDecoder
+from pymodbus.client import AsyncModbusTcpClient
+
+from . import (
+    AlfenEve, BreakerOpenException, CarCharger, Sample, registerType, breakerState, MODE_3_STATE_MAP,
+    SETPOINT_TIMEOUT, SETPOINT_POLL_INTERVAL,
+    _read_outcome, _write_outcome, _read_event, _write_event, _exception_outcome
+)
+
+
+# Default number of chargers polled at the same time by read_all_chargers()
+MAX_CONCURRENCY = 32
+
+
+class AsyncAlfenEve(AlfenEve):
+
+    model = "Alfen Eve"
+    wordorder = Endian.BIG
+
+    def _create_client(self):
+        # Reconnects and retries are driven by the retry policy, not by pymodbus
+        # retrying dead hosts in the background or resending timed out requests.
+        return AsyncModbusTcpClient(
+            host=self.host,
+            port=self.port,
+            timeout=self.timeout,
+            retries=0,
+            reconnect_delay=0
+        )
+
+    async def _read_holding_registers(self, slave, address, length):
+        registers = await self._read_holding_words(slave, address, length)
+
+        if registers is None:
+            return None
+
+        return BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=self.wordorder)
+
+    async def _probe(self):
+        if not (self.connected() or await self.connect()):
+            return False
+        if self.probe_register is None:
+            return True
+
+        slave, address, length = self.registers[self.probe_register][:3]
+
+        try:
+            result = await self.client.read_holding_registers(address, length, slave=slave)
+        except ModbusException as e:
+            result = e
+
+        return _read_outcome(result, length) == "ok"
+
+    async def _breaker_allow(self):
+        state = self.breaker.acquire()
+
+        if state is breakerState.HALF_OPEN:
+            if await self._probe():
+                self.breaker.success()
+                return True
+
+            self.breaker.failure()
+            return False
+
+        return state is breakerState.CLOSED
+
+    async def _read_holding_words(self, slave, address, length, deadline=None):
+        policy = self.retry_policy
+        instrument = self.instrument
+        breaker = self.breaker
+        attempt = 0
+
+        if breaker is not None and not await self._breaker_allow():
+            return None
+
+        if deadline is None:
+            deadline = policy.deadline()
+        elif policy.expired(deadline):
+            return None
+
+        while True:
+            if self.connected() or await self.connect():
+                if instrument is not None:
+                    start = time.perf_counter()
+
+                try:
+                    result = await self.client.read_holding_registers(address, length, slave=slave)
+                except ModbusException as e:
+                    result = e
+
+                outcome = _read_outcome(result, length)
+
+                if instrument is not None:
+                    instrument.on_request(self, _read_event(slave, address, length, time.perf_counter() - start, outcome, result))
+
+                if outcome == "ok":
+                    if breaker is not None:
+                        breaker.success()
+                    return result.registers
+            else:
+                outcome = "disconnected"
+
+            attempt += 1
+            delay = policy.delay(attempt, outcome, deadline)
+
+            if delay is None:
+                if breaker is not None and outcome != "exception":
+                    breaker.failure()
+                return None
+            if instrument is not None:
+                instrument.on_retry(self, attempt, outcome)
+
+            await asyncio.sleep(delay)
+
+    async def _write_holding_register(self, slave, address, value):
+        if self.breaker is not None and not await self._breaker_allow():
+            raise BreakerOpenException(f"{self.host}:{self.port}: circuit breaker open")
+
+        if self.instrument is None:
+            return await self.client.write_registers(address=address, values=value, slave=slave)
+
+        start = time.perf_counter()
+        result = await self.client.write_registers(address=address, values=value, slave=slave)
+        self.instrument.on_request(self, _write_event(slave, address, len(value), time.perf_counter() - start, _write_outcome(result)))
+
+        return result
+
+    async def _read(self, value):
+        slave, address, length, rtype, dtype, vtype, label, fmt, batch = value
+
+        try:
+            if rtype == registerType.HOLDING:
+                return self._decode_value(await self._read_holding_registers(slave, address, length), length, dtype, vtype)
+            else:
+                raise NotImplementedError(rtype)
+        except NotImplementedError:
+            raise
+        except AttributeError:
+            return False
+
+    async def _read_raw(self, plan, rtype, deadline=None):
+        try:
+            if rtype == registerType.HOLDING:
+                data = await self._read_holding_words(plan.slave, plan.address, plan.length, deadline)
+            else:
+                raise NotImplementedError(rtype)
+        except NotImplementedError:
+            raise
+
+        if not data:
+            return None
+
+        return plan.pack(data)
+
+    async def _read_all(self, plan, rtype, deadline=None):
+        data = await self._read_raw(plan, rtype, deadline)
+
+        if data is None:
+            return {}
+
+        return self._decode(plan, data)
+
+    async def _read_changes(self, plan, rtype, deadbands, deadline=None):
+        data = await self._read_raw(plan, rtype, deadline)
+
+        if data is None:
+            return {}
+
+        return self._decode_changes(plan, data, deadbands)
+
+    async def _write(self, value, data):
+        slave, address, length, rtype, dtype, vtype, label, fmt, batch = value
+
+        try:
+            if rtype == registerType.HOLDING:
+                return await self._write_holding_register(slave, address, self._encode_value(data, dtype))
+            else:
+                raise NotImplementedError(rtype)
+        except NotImplementedError:
+            raise
+
+    async def connect(self):
+        if self.instrument is None:
+            return await self.client.connect()
+
+        start = time.perf_counter()
+        connected = await self.client.connect()
+        self.instrument.on_connect(self, connected, time.perf_counter() - start)
+
+        return connected
+
+    def disconnect(self):
+        self.client.close()
+
+        if self.instrument is not None:
+            self.instrument.on_disconnect(self)
+
+    def connected(self):
+        return self.client.connected
+
+    async def read(self, key, socket=None):
+        if key not in self.registers:
+            raise KeyError(key)
+
+        socket = self._socket(socket)
+        cache = self.cache and socket is None
+
+        if cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                return {key: cached[1]}
+
+        result = {key: await self._read(self._registers_for(socket)[key])}
+
+        if cache:
+            self._cache_put(result)
+
+        return result
+
+    async def write(self, key, data, socket=None):
+        if key not in self.registers:
+            raise KeyError(key)
+
+        socket = self._socket(socket)
+        if socket is None:
+            self.invalidate(key)
+
+        return await self._write(self._registers_for(socket)[key], data)
+
+    async def write_many(self, values):
+        for key in values:
+            if key not in self.registers:
+                raise KeyError(key)
+
+            self.invalidate(key)
+
+        return [
+            await self._write_holding_register(slave, address, words)
+            for slave, address, words, keys in self._plan_writes(values)
+        ]
+
+    async def _read_plans(self, plans, delta=False, deadbands=None, cache=True):
+        deadline = self.retry_policy.deadline()
+        results = {}
+
+        for plan in plans:
+            if delta:
+                results.update(await self._read_changes(plan, plan.rtype, deadbands or {}, deadline))
+            else:
+                results.update(await self._read_all(plan, plan.rtype, deadline))
+
+        if self.cache and cache:
+            self._cache_put(results)
+
+        return results
+
+    async def read_many(self, keys, delta=False, deadbands=None, socket=None):
+        """Read the given registers and/or register groups in as few requests as possible."""
+        socket = self._socket(socket)
+        return await self._read_plans(self._batches_for(self._resolve_keys(keys), socket), delta, deadbands, socket is None)
+
+    async def read_all(self, rtype=registerType.HOLDING, delta=False, deadbands=None, socket=None):
+        socket = self._socket(socket)
+        return await self._read_plans(self._batches(rtype, socket), delta, deadbands, socket is None)
+
+    async def nr_of_sockets(self):
+        if self._nr_of_sockets is None:
+            if self.socket_slave is None:
+                return 0
+
+            sockets = (await self.read("nr_of_sockets"))["nr_of_sockets"]
+            if not sockets:
+                return 1
+
+            self._nr_of_sockets = sockets
+
+        return self._nr_of_sockets
+
+    async def read_sockets(self, sockets=None, rtype=registerType.HOLDING, delta=False, deadbands=None):
+        keys = self._socket_keys(rtype)
+
+        if sockets is None:
+            sockets = range(1, await self.nr_of_sockets() + 1)
+
+        return {
+            socket: await self._read_plans(self._batches_for(keys, self._socket(socket)), delta, deadbands, self._socket(socket) is None)
+            for socket in sockets
+        }
+
+    async def stream(self, keys=None, interval=1, count=None):
+        """Async iterator flavour of AlfenEve.stream()."""
+        keys = self._stream_keys(keys)
+        plans = self._batches_for(keys)
+        next_poll = time.monotonic()
+        missed = 0
+        polls = 0
+
+        while count is None or polls < count:
+            timestamp = time.time()
+            results = await self._read_plans(plans)
+            yield Sample(timestamp, keys, tuple(map(results.get, keys)), missed)
+            polls += 1
+
+            next_poll += interval
+            now = time.monotonic()
+            missed = 0
+
+            if now > next_poll:
+                missed = int((now - next_poll) // interval) + 1
+                next_poll += missed * interval
+
+            await asyncio.sleep(max(next_poll - time.monotonic(), 0))
+
+
+class AsyncCarCharger(AsyncAlfenEve):
+
+    registers = CarCharger.registers
+    register_classes = CarCharger.register_classes
+    register_groups = CarCharger.register_groups
+    probe_register = CarCharger.probe_register
+    socket_slave = CarCharger.socket_slave
+
+    def __init__(self, *args, **kwargs):
+        self.model = "Car Charger"
+        self.wordorder = Endian.BIG
+
+        super().__init__(*args, **kwargs)
+
+    async def read_with_retry(self, key):
+        deadline = self.retry_policy.deadline()
+        attempt = 0
+
+        while True:
+            if self.breaker is not None and self.breaker.is_open():
+                raise BreakerOpenException(f"{self.host}:{self.port}: circuit breaker open")
+
+            try:
+                if not self.connected():
+                    await self.connect()
+                return await self.read(key)
+            except Exception as e:
+                self.disconnect()
+
+                attempt += 1
+                outcome = _exception_outcome(e)
+                delay = self.retry_policy.delay(attempt, outcome, deadline)
+
+                if delay is None:
+                    syslog.syslog(f"Failed to read {key} after {attempt} attempts: {e}")
+                    raise
+                if self.instrument is not None:
+                    self.instrument.on_retry(self, attempt, outcome)
+
+                await asyncio.sleep(delay)
+
+    async def write_with_retry(self, key: str, value: int) -> bool:
+        """Write a value to the car_charger with retries."""
+        deadline = self.retry_policy.deadline()
+        attempt = 0
+
+        while True:
+            if self.breaker is not None and self.breaker.is_open():
+                raise BreakerOpenException(f"{self.host}:{self.port}: circuit breaker open")
+
+            try:
+                if not self.connected():
+                    await self.connect()
+                result = await self.write(key, value)
+            except Exception as e:
+                self.disconnect()
+                result = error = e
+                outcome = _exception_outcome(e)
+            else:
+                error = None
+                # a timeout or exception response comes back as the result
+                outcome = _write_outcome(result)
+
+                if outcome == "ok":
+                    return True
+
+                self.disconnect()
+
+            attempt += 1
+            delay = self.retry_policy.delay(attempt, outcome, deadline)
+
+            if delay is None:
+                syslog.syslog(f"Failed to write {key} after {attempt} attempts: {result}")
+                if error is not None:
+                    raise error
+                return False
+            if self.instrument is not None:
+                self.instrument.on_retry(self, attempt, outcome)
+
+            await asyncio.sleep(delay)
+
+    async def get_status(self):
+        mode_3_state = await self.read_with_retry("mode_3_state")
+        status = MODE_3_STATE_MAP[mode_3_state['mode_3_state']]
+        return status
+
+    async def get_phases(self):
+        phases = (await self.read_with_retry('charge_using_1_or_3_phases'))['charge_using_1_or_3_phases']
+        return phases
+
+    async def get_current(self):
+        current = (await self.read_with_retry('modbus_slave_max_current'))['modbus_slave_max_current']
+        return current
+
+    async def pause_charging(self):
+        PAUSE_CURRENT = 5
+        syslog.syslog("Stop Charging...")
+        current = await self.get_current()
+        syslog.syslog(f"Current usage in A: {current}")
+        if current > 5.5:
+            syslog.syslog("Pausing...")
+            await self.set_current(PAUSE_CURRENT)
+            syslog.syslog("Paused...")
+        else:
+            syslog.syslog("Already paused charging...")
+
+    async def switch_phase(self, phases):
+        if (phases == 1 or phases == 3):
+            current_phases = await self.get_phases()
+
+            if current_phases == phases:
+                syslog.syslog(f"No need to switch, already at {phases} phase...")
+            else:
+                try:
+                    syslog.syslog(f"Switch to {phases} phase(s)...")
+                    syslog.syslog(f"Current phase(s): {current_phases}")
+                    await self.write_with_retry('charge_using_1_or_3_phases', phases)
+                except Exception as e:
+                    syslog.syslog(str(e))
+                finally:
+                    current_phases = await self.get_phases()
+                    syslog.syslog(f"Current phase(s): {current_phases}")
+        else:
+            syslog.syslog(f"Invalid # of phases: {phases}...")
+
+    async def set_current(self, current):
+        await self.write_with_retry('modbus_slave_max_current', current)
+
+    async def wait_for_setpoint(self, timeout=SETPOINT_TIMEOUT, interval=SETPOINT_POLL_INTERVAL):
+        deadline = time.monotonic() + timeout
+
+        while True:
+            accounted = (await self.read("modbus_slave_received_setpoint_accounted_for"))["modbus_slave_received_setpoint_accounted_for"]
+
+            if accounted == 1:
+                return True
+            if time.monotonic() + interval > deadline:
+                return False
+
+            await asyncio.sleep(interval)
+
+    async def _write_run_with_retry(self, slave, address, words, keys):
+        deadline = self.retry_policy.deadline()
+        attempt = 0
+
+        while True:
+            try:
+                result = await self._write_holding_register(slave, address, words)
+                outcome = _write_outcome(result)
+            except ModbusException as e:
+                result = e
+                outcome = _exception_outcome(e)
+
+            if outcome == "ok":
+                return True
+
+            attempt += 1
+            delay = self.retry_policy.delay(attempt, outcome, deadline)
+
+            if delay is None:
+                syslog.syslog(f"Failed to write {', '.join(keys)} after {attempt} attempts: {result}")
+                return False
+            if self.instrument is not None:
+                self.instrument.on_retry(self, attempt, outcome)
+
+            await asyncio.sleep(delay)
+
+    async def _write_profile(self, values):
+        for key in values:
+            self.invalidate(key)
+
+        for slave, address, words, keys in self._plan_writes(values):
+            if not await self._write_run_with_retry(slave, address, words, keys):
+                return False
+
+        if not await self.wait_for_setpoint():
+            syslog.syslog(f"Setpoint {values} not accounted for within {SETPOINT_TIMEOUT}s")
+
+        return True
+
+    async def set_charge_profile(self, phases, current):
+        try:
+            await self._set_charge_profile(phases, current)
+        except ModbusException as e:
+            syslog.syslog(f"Failed to set the charge profile: {e}")
+
+    async def _set_charge_profile(self, phases, current):
+        PAUSE_CURRENT = 5
+        profile = ("mode_3_state", "charge_using_1_or_3_phases", "modbus_slave_max_current")
+
+        values = await self.read_many(profile)
+        # a small max_gap splits the profile over several spans, any of which can fail
+        if not values.get("mode_3_state") or any(values.get(k) is None or values.get(k) is False for k in profile):
+            syslog.syslog("Failed to read the charge profile, so no changes in charge profile applied.")
+            return
+
+        status = MODE_3_STATE_MAP[values["mode_3_state"]]
+        if (status == "Charging" or status == "Connected"):
+            current_phases = values["charge_using_1_or_3_phases"]
+            momentary_current = values["modbus_slave_max_current"]
+            syslog.syslog(f"Currently Charge Profile is: Phase(s): {current_phases}; Current: {momentary_current} A.")
+            syslog.syslog(f"Current Phase(s): {current_phases} versus Requested Phase(s): {phases}")
+
+            update = {"modbus_slave_max_current": current}
+
+            if current_phases != phases:
+                if phases == 1 or phases == 3:
+                    if status == "Charging" and momentary_current > 5.5:
+                        syslog.syslog("Pausing...")
+                        if not await self._write_profile({"modbus_slave_max_current": PAUSE_CURRENT}):
+                            return
+                    update = {"charge_using_1_or_3_phases": phases, **update}
+                else:
+                    syslog.syslog(f"Invalid # of phases: {phases}...")
+
+            if not await self._write_profile(update):
+                return
+
+            values = await self.read_many(profile[1:])
+            phases = values.get("charge_using_1_or_3_phases")
+            current = values.get("modbus_slave_max_current")
+            syslog.syslog(f"Charge Profile Set: Phase(s): {phases}; Current: {current} A.")
+        else:
+            syslog.syslog(f"Car is not connected: {status}, so no changes in charge profile applied.")
+
+
+async def read_all_chargers(chargers, concurrency=MAX_CONCURRENCY, rtype=registerType.HOLDING):
+    """Run read_all() on many chargers, at most `concurrency` at a time.
+
+    Returns a list in the order of `chargers`, holding either the read_all()
+    result or the exception raised for that charger.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _read_all(charger):
+        async with semaphore:
+            return await charger.read_all(rtype)
+
+    return await asyncio.gather(*(_read_all(c) for c in chargers), return_exceptions=True)
@@ -0,0 +1,237 @@
+# Load balancing for a fleet of chargers behind one grid connection. A single
+# coalesced poll gives every charger's Mode 3 state, phases and currents, the
+# per-phase site limit is then shared out over all chargers at once with NumPy
+# (max-min fair per phase), and only setpoints that moved beyond a deadband are
+# written, concurrently on the fleet's thread pool.
+#
+#   allocator = FleetAllocator(fleet, limit=(63, 63, 63))
+#   allocation = allocator.rebalance()
+
+import collections
+
+from . import MODE_3_STATE_MAP, _write_outcome
+from .fleet import pollStatus
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+ALLOCATION_KEYS = (
+    "mode_3_state", "charge_using_1_or_3_phases", "modbus_slave_max_current", "modbus_slave_max_current_valid_time",
+    "current_phase_L1", "current_phase_L2", "current_phase_L3", "real_power_sum", "station_active_max_current",
+    "active_load_balancing_safe_current", "actual_applied_max_current"
+)
+# Lowest current a car charges at, setpoints below it pause charging
+MIN_CURRENT = 6.0
+PAUSE_CURRENT = 5.0
+MAX_CURRENT = 32.0
+# Assumed safe current of a charger that was never read
+SAFE_CURRENT = 6.0
+# Setpoints closer than this to the charger's current one are not written
+DEADBAND = 0.5
+# Setpoints expiring within this many seconds are written even if unchanged
+REFRESH_MARGIN = 10
+# A phase drawing more than this many amps is in use, whatever charge_using_1_or_3_phases says
+PHASE_THRESHOLD = 1.0
+# A car drawing this much below the current applied to it is limited by the car, it is offered what it draws plus this
+CAR_HEADROOM = 2.0
+
+# hosts, setpoints (one per host, NaN where the host could not be read), the
+# PollResults of the writes, and those of the poll the allocation is based on
+Allocation = collections.namedtuple("Allocation", "hosts setpoints writes results")
+
+
+def _level(mask, demand, capacity, minimum):
+    # Highest common current level so that no phase exceeds its capacity, when
+    # every charger gets the level clipped to [minimum, its demand]. Phase usage
+    # is piecewise linear in the level with breakpoints at the demands, so it is
+    # evaluated at all breakpoints at once and solved on the last feasible segment.
+    breaks = np.unique(np.concatenate(([minimum], demand)))
+    usage = np.clip(breaks[:, None], minimum, demand[None, :]) @ mask
+    feasible = np.flatnonzero(np.all(usage <= capacity + 1e-9, axis=1))
+
+    if not len(feasible):
+        return minimum
+
+    k = feasible[-1]
+    if k == len(breaks) - 1:
+        return breaks[-1]
+
+    slope = ((demand > breaks[k])[:, None] & (mask > 0)).sum(axis=0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        step = np.where(slope > 0, (capacity - usage[k]) / slope, np.inf).min()
+
+    return min(breaks[k] + step, breaks[k + 1])
+
+
+def allocate(mask, demand, limit, minimum=MIN_CURRENT):
+    """Share limit (amps per phase) over chargers using the phases in mask (N x 3) and wanting demand (N).
+
+    Every charger gets at least minimum, the caller leaves out chargers that
+    don't fit. Chargers on a phase that runs out are frozen at the level reached
+    so far, the others keep rising on the capacity that is left (max-min fair).
+    """
+    mask = mask.astype(float)
+    demand = np.maximum(demand, minimum)
+    allocation = np.full(len(demand), float(minimum))
+    frozen = np.zeros(len(demand), dtype=bool)
+    limit = np.asarray(limit, dtype=float)
+
+    # every round saturates a phase or satisfies everyone left
+    for _ in range(4):
+        free = ~frozen
+        if not free.any():
+            break
+
+        capacity = limit - allocation[frozen] @ mask[frozen]
+        level = _level(mask[free], demand[free], capacity, minimum)
+        allocation[free] = np.clip(level, minimum, demand[free])
+
+        saturated = limit - allocation @ mask <= 1e-6
+        frozen |= (allocation >= demand) | (mask[:, saturated] > 0).any(axis=1)
+
+    return allocation
+
+
+class FleetAllocator:
+
+    def __init__(
+        self, fleet, limit, min_current=MIN_CURRENT, max_current=MAX_CURRENT,
+        deadband=DEADBAND, refresh_margin=REFRESH_MARGIN, safe_current=SAFE_CURRENT, scheduler=None
+    ):
+        """Balance limit (amps, one number or one per phase) over the chargers of fleet.
+
+        With a SetpointScheduler, setpoints are handed to it so they are kept
+        alive between rebalances, otherwise they are written once.
+        """
+        if np is None:
+            raise ImportError("numpy is required for FleetAllocator")
+
+        self.fleet = fleet
+        self.limit = np.broadcast_to(np.asarray(limit, dtype=float), (3,))
+        self.min_current = min_current
+        self.max_current = max_current
+        self.deadband = deadband
+        self.refresh_margin = refresh_margin
+        self.safe_current = safe_current
+        self.scheduler = scheduler
+
+        self.rebalances = 0
+        self.writes = 0
+        # amps per phase held back for the hosts the last allocation couldn't read
+        self.reserved = 0.0
+
+        # last known setpoint and safe current by host
+        self._setpoints = {}
+        self._safe_currents = {}
+
+    def __repr__(self):
+        return f"FleetAllocator({len(self.fleet.chargers)} chargers: limit={tuple(self.limit)}, rebalances={self.rebalances}, writes={self.writes})"
+
+    def poll(self, hosts=None):
+        return self.fleet.poll(lambda charger: charger.read_many(ALLOCATION_KEYS) or None, hosts)
+
+    def allocate(self, results, limit=None):
+        """Setpoints for the hosts of a poll of ALLOCATION_KEYS, returns (hosts, setpoints, values).
+
+        values holds one column per ALLOCATION_KEYS entry (mode_3_state as 1
+        when a car is connected), hosts that could not be read are NaN.
+
+        Every charger of the fleet that is not read keeps drawing its last known
+        setpoint (or its safe current), so that much is held back from limit on
+        all phases.
+        """
+        limit = self.limit if limit is None else np.broadcast_to(np.asarray(limit, dtype=float), (3,))
+        hosts = list(results)
+        values = np.full((len(hosts), len(ALLOCATION_KEYS)), np.nan)
+
+        for i, host in enumerate(hosts):
+            result = results[host]
+            if result.status != pollStatus.OK:
+                continue
+
+            row = [result.values.get(k) for k in ALLOCATION_KEYS]
+            row[0] = float(MODE_3_STATE_MAP.get(row[0]) in ("Connected", "Charging"))
+            values[i] = [np.nan if v is None or v is False else v for v in row]
+
+        state, phases, setpoint, valid_time, l1, l2, l3, power, station_max, safe, applied = values.T
+        read = ~np.isnan(state)
+
+        for i in np.flatnonzero(read):
+            if not np.isnan(setpoint[i]):
+                self._setpoints[hosts[i]] = setpoint[i]
+            if not np.isnan(safe[i]):
+                self._safe_currents[hosts[i]] = safe[i]
+
+        read_hosts = {hosts[i] for i in np.flatnonzero(read)}
+        self.reserved = sum(
+            self._setpoints.get(host, self._safe_currents.get(host, self.safe_current))
+            for host in self.fleet.chargers if host not in read_hosts
+        )
+        limit = limit - self.reserved
+        connected = read & (state == 1)
+        currents = np.nan_to_num(np.column_stack((l1, l2, l3)))
+
+        mask = currents > PHASE_THRESHOLD
+        mask[:, 0] |= read
+        mask[:, 1:] |= (phases == 3)[:, None]
+
+        demand = np.fmin(np.nan_to_num(station_max, nan=self.max_current), self.max_current)
+        drawn = currents.max(axis=1)
+        # compared with the applied current, a charger on its safe current is not car limited
+        car_limited = connected & (power > 0) & (drawn < applied - CAR_HEADROOM)
+        demand = np.where(car_limited, drawn + CAR_HEADROOM, demand)
+        # without a car a charger only holds the minimum, so a car plugging in
+        # before the next rebalance stays within the limit
+        demand = np.where(connected, demand, self.min_current)
+
+        # chargers with a car come first when not everyone fits at the minimum
+        order = np.argsort(~connected[read], kind="stable")
+        candidates = np.flatnonzero(read)[order]
+        needed = np.cumsum(mask[candidates] * self.min_current, axis=0)
+        served = candidates[np.all(needed <= limit + 1e-9, axis=1)]
+
+        setpoints = np.where(read, PAUSE_CURRENT, np.nan)
+
+        if len(served):
+            setpoints[served] = np.floor(allocate(mask[served], demand[served], limit, self.min_current) * 10) / 10
+
+        return hosts, setpoints, values
+
+    def _write(self, charger, current):
+        if self.scheduler is not None:
+            return self.scheduler.set(charger, current)
+
+        return all(_write_outcome(result) == "ok" for result in charger.write_many({"modbus_slave_max_current": current}))
+
+    def rebalance(self, limit=None, hosts=None):
+        """Poll the fleet once, allocate, and write the setpoints that changed beyond the deadband."""
+        results = self.poll(hosts)
+        hosts, setpoints, values = self.allocate(results, limit)
+        current = values[:, ALLOCATION_KEYS.index("modbus_slave_max_current")]
+        valid_time = values[:, ALLOCATION_KEYS.index("modbus_slave_max_current_valid_time")]
+
+        with np.errstate(invalid="ignore"):
+            changed = ~np.isnan(setpoints) & (
+                ~(np.abs(setpoints - current) <= self.deadband)
+                | ((setpoints < self.min_current) != (current < self.min_current))
+                | ~(valid_time >= self.refresh_margin)
+            )
+
+        targets = {self.fleet.chargers[hosts[i]]: float(setpoints[i]) for i in np.flatnonzero(changed)}
+        writes = {}
+
+        if targets:
+            writes = self.fleet.poll(lambda charger: self._write(charger, targets[charger]), [hosts[i] for i in np.flatnonzero(changed)])
+
+        for host, result in writes.items():
+            if result.status == pollStatus.OK:
+                self._setpoints[host] = targets[self.fleet.chargers[host]]
+
+        self.rebalances += 1
+        self.writes += len(writes)
+
+        return Allocation(hosts, setpoints, writes, results)
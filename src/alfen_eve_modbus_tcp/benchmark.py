@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Benchmarks for poll throughput, latency and decode cost, run against the local
+# simulator. Results are printed as JSON so they can be compared between releases:
+#
+#   python3 -m alfen_eve_modbus_tcp.benchmark --iterations 200 > bench.json
+
+import argparse
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+
+from pymodbus.constants import Endian
+from pymodbus.payload import BinaryPayloadDecoder
+
+from . import CarCharger, registerType
+from .fleet import ChargerFleet
+from .simulator import Simulator
+from .vectorized import decode_spans, np
+
+
+CONTROL_KEYS = (
+    "mode_3_state", "real_power_sum", "current_phase_L1", "current_phase_L2", "current_phase_L3",
+    "actual_applied_max_current"
+)
+
+
+def _percentiles(durations):
+    durations = sorted(durations)
+
+    return {
+        "p50_ms": round(statistics.median(durations) * 1000, 3),
+        "p99_ms": round(durations[min(int(len(durations) * 0.99), len(durations) - 1)] * 1000, 3),
+        "max_ms": round(durations[-1] * 1000, 3)
+    }
+
+
+def bench_call(fn, simulated, iterations):
+    """Latency percentiles and Modbus requests per call of fn()."""
+    durations = []
+    requests = simulated.requests
+
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+
+    return {
+        "iterations": iterations,
+        "requests_per_call": (simulated.requests - requests) / iterations,
+        **_percentiles(durations)
+    }
+
+
+def bench_allocations(fn, iterations=10):
+    """Peak traced memory and net allocated blocks per call of fn()."""
+    fn()
+    tracemalloc.start()
+    peak = 0
+    blocks = 0
+
+    for i in range(iterations):
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+        blocks += sum(stat.count_diff for stat in tracemalloc.take_snapshot().compare_to(before, "filename"))
+
+    tracemalloc.stop()
+
+    return {"peak_bytes": peak, "net_blocks": blocks / iterations}
+
+
+def bench_decode(charger, iterations):
+    """Decode time of a full register map, field by field versus one struct per span."""
+    plans = charger._batches(registerType.HOLDING)
+    spans = []
+
+    for plan in plans:
+        words = charger._read_holding_words(plan.slave, plan.address, plan.length)
+        spans.append((plan, words))
+
+    def per_field():
+        for plan, words in spans:
+            data = BinaryPayloadDecoder.fromRegisters(words, byteorder=Endian.BIG, wordorder=charger.wordorder)
+            offset = plan.address
+
+            for k, v in plan.registers.items():
+                slave, address, length, rtype, dtype, vtype, label, unit, batch = v
+
+                if address > offset:
+                    data.skip_bytes((address - offset) * 2)
+                    offset = address
+
+                charger._decode_value(data, length, dtype, vtype)
+                offset += length
+
+    def per_span():
+        for plan, words in spans:
+            plan.decode(words)
+
+    results = {"registers": sum(len(plan.keys) for plan in plans), "spans": len(plans)}
+
+    for name, fn in (("decode_value", per_field), ("decode_plan", per_span)):
+        start = time.perf_counter()
+        for i in range(iterations):
+            fn()
+        results[f"{name}_us"] = round((time.perf_counter() - start) / iterations * 1e6, 2)
+
+    return results
+
+
+def bench_array_decode(charger, chargers, iterations, keys=("meter",)):
+    """Decode time of the same spans from many chargers, per charger versus stacked with NumPy."""
+    plans = charger._batches_for(charger._resolve_keys(keys))
+    spans = {plan: [charger._read_raw(plan, plan.rtype)] * chargers for plan in plans}
+
+    def per_charger():
+        for i in range(chargers):
+            for plan in plans:
+                plan.decode_bytes(spans[plan][i])
+
+    results = {"chargers": chargers, "registers": sum(len(plan.keys) for plan in plans)}
+
+    for name, fn in (("decode_plan", per_charger), ("decode_numpy", lambda: decode_spans(plans, spans))):
+        fn()
+        start = time.perf_counter()
+        for i in range(iterations):
+            fn()
+        results[f"{name}_us"] = round((time.perf_counter() - start) / iterations * 1e6, 2)
+
+    return results
+
+
+def bench_fleet(sizes, iterations, **kwargs):
+    """read_all() cycle time over a fleet of simulated chargers."""
+    results = []
+
+    for size in sizes:
+        with Simulator(count=size, port=0, **kwargs) as simulator:
+            fleet = ChargerFleet(simulator.addresses, persistent=True)
+            fleet.read_all()
+
+            durations = []
+            for i in range(iterations):
+                start = time.perf_counter()
+                fleet.read_all()
+                durations.append(time.perf_counter() - start)
+
+            fleet.close()
+
+        results.append({"chargers": size, **_percentiles(durations)})
+
+    return results
+
+
+def run(iterations=100, fleet_sizes=(1, 10, 50), latency=0, profile=True):
+    results = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "latency_s": latency
+    }
+
+    with Simulator(count=1, port=0, latency=latency, script=[(0, "C2")]) as simulator:
+        host, port = simulator.addresses[0]
+        simulated = simulator.chargers[0]
+        charger = CarCharger(host=host, port=port, persistent=True)
+        charger.connect()
+
+        results["read"] = bench_call(lambda: charger.read("mode_3_state"), simulated, iterations)
+        results["read_many"] = bench_call(lambda: charger.read_many(CONTROL_KEYS), simulated, iterations)
+        results["read_all"] = bench_call(charger.read_all, simulated, iterations)
+        results["read_with_retry"] = bench_call(lambda: charger.read_with_retry("mode_3_state"), simulated, iterations)
+
+        if profile:
+            results["set_charge_profile"] = bench_call(lambda: charger.set_charge_profile(3, 10.0), simulated, 1)
+
+        results["allocations"] = {
+            "read_all": bench_allocations(charger.read_all),
+            "read_many": bench_allocations(lambda: charger.read_many(CONTROL_KEYS))
+        }
+        results["decode"] = bench_decode(charger, iterations)
+
+        if np is not None:
+            results["fleet_decode"] = bench_array_decode(charger, 500, max(iterations // 10, 1))
+
+        charger.disconnect()
+
+    results["fleet_read_all"] = bench_fleet(fleet_sizes, max(iterations // 10, 1), latency=latency)
+
+    return results
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--iterations", type=int, default=100, help="Calls per measurement")
+    argparser.add_argument("--fleet", type=int, nargs="*", default=[1, 10, 50], help="Fleet sizes to measure")
+    argparser.add_argument("--latency", type=float, default=0, help="Simulated response latency in seconds")
+    argparser.add_argument("--skip-profile", action="store_true", default=False, help="Skip set_charge_profile")
+    argparser.add_argument("--output", type=str, default=None, help="Write JSON to this file instead of stdout")
+    args = argparser.parse_args()
+
+    results = run(args.iterations, args.fleet, args.latency, not args.skip_profile)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
@@ -0,0 +1,118 @@
+# Fixed-size columnar ring buffer for Samples yielded by AlfenEve.stream().
+# Every register gets its own array('d') column, so an hour of 1 Hz samples
+# costs 8 bytes per value instead of a dict of Python floats per poll.
+
+import bisect
+import csv
+
+from array import array
+
+from . import CarCharger, registerDataType
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class SampleBuffer:
+
+    def __init__(self, keys, capacity=3600, registers=CarCharger.registers):
+        self.keys = tuple(keys)
+        self.capacity = capacity
+
+        # String registers (like mode_3_state) are stored as codes into a
+        # per-column list of the values seen so far.
+        self.categories = {
+            i: [] for i, k in enumerate(self.keys)
+            if registers[k][4] == registerDataType.STRING
+        }
+        self._codes = {i: {} for i in self.categories}
+
+        self._timestamps = array("d", [0.0]) * capacity
+        self._columns = [array("d", [0.0]) * capacity for k in self.keys]
+        self._head = 0
+        self._size = 0
+
+    def __repr__(self):
+        return f"SampleBuffer({len(self.keys)} columns: {self._size}/{self.capacity} samples)"
+
+    def __len__(self):
+        return self._size
+
+    def nbytes(self):
+        return (len(self._columns) + 1) * self.capacity * self._timestamps.itemsize
+
+    def append(self, sample):
+        if sample.keys is not self.keys and tuple(sample.keys) != self.keys:
+            raise ValueError("sample keys do not match the buffer layout")
+
+        head = self._head
+        self._timestamps[head] = sample.timestamp
+
+        for i, value in enumerate(sample.values):
+            if value is None:
+                value = float("nan")
+            elif i in self._codes:
+                codes = self._codes[i]
+                if value not in codes:
+                    codes[value] = len(codes)
+                    self.categories[i].append(value)
+                value = codes[value]
+
+            self._columns[i][head] = value
+
+        self._head = (head + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def extend(self, samples):
+        for sample in samples:
+            self.append(sample)
+
+    def _ordered(self, column):
+        # oldest sample first
+        if self._size < self.capacity:
+            return column[:self._size]
+
+        return column[self._head:] + column[:self._head]
+
+    def _window(self, timestamps, start, end):
+        first = 0 if start is None else bisect.bisect_left(timestamps, start)
+        last = len(timestamps) if end is None else bisect.bisect_right(timestamps, end)
+
+        return first, last
+
+    def to_numpy(self, start=None, end=None):
+        """Return (timestamps, values) for samples with start <= timestamp <= end.
+
+        values has one row per sample and one column per key. String columns
+        hold codes into self.categories.
+        """
+        if np is None:
+            raise ImportError("numpy is required for SampleBuffer.to_numpy()")
+
+        timestamps = np.frombuffer(self._ordered(self._timestamps), dtype=np.float64)
+        first = 0 if start is None else np.searchsorted(timestamps, start)
+        last = len(timestamps) if end is None else np.searchsorted(timestamps, end, side="right")
+
+        values = np.empty((last - first, len(self.keys)))
+        for i, column in enumerate(self._columns):
+            values[:, i] = np.frombuffer(self._ordered(column), dtype=np.float64)[first:last]
+
+        return timestamps[first:last], values
+
+    def to_csv(self, file, start=None, end=None):
+        timestamps = self._ordered(self._timestamps)
+        first, last = self._window(timestamps, start, end)
+        columns = []
+
+        for i, column in enumerate(self._columns):
+            column = self._ordered(column)[first:last]
+            if i in self.categories:
+                labels = self.categories[i]
+                column = [labels[int(code)] if code == code else "" for code in column]
+            columns.append(column)
+
+        writer = csv.writer(file)
+        writer.writerow(("timestamp",) + self.keys)
+        writer.writerows(zip(timestamps[first:last], *columns))
@@ -0,0 +1,167 @@
+# Poll many car chargers at once from a bounded thread pool. Every host gets its
+# own deadline and the whole cycle gets one too, so a single unreachable charger
+# only costs its own slot instead of stalling everyone else.
+
+import collections
+import enum
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import CarCharger, registerType, MAX_RETRIES, RETRY_DELAY
+from .vectorized import decode_spans
+
+
+MAX_WORKERS = 16
+HOST_DEADLINE = 5
+CYCLE_DEADLINE = 10
+
+
+class pollStatus(enum.Enum):
+    OK = 1
+    ERROR = 2
+    TIMEOUT = 3
+    BUSY = 4
+    OPEN = 5
+
+
+# host, pollStatus, values (dict, empty unless OK), exception (or None), seconds spent
+PollResult = collections.namedtuple("PollResult", "host status values error duration")
+
+
+class ChargerFleet:
+
+    def __init__(
+        self, hosts, port=502,
+        timeout=RETRY_DELAY, retries=MAX_RETRIES,
+        max_workers=MAX_WORKERS, host_deadline=HOST_DEADLINE, cycle_deadline=CYCLE_DEADLINE,
+        charger=CarCharger, **kwargs
+    ):
+        self.host_deadline = host_deadline
+        self.cycle_deadline = cycle_deadline
+        self.chargers = {}
+
+        # hosts are either "host" strings or (host, port) tuples, results are
+        # keyed the same way
+        for host in hosts:
+            address, host_port = host if isinstance(host, tuple) else (host, port)
+            self.chargers[host] = charger(host=address, port=host_port, timeout=timeout, retries=retries, **kwargs)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._running = {}
+
+    def __repr__(self):
+        return f"ChargerFleet({len(self.chargers)} chargers: host_deadline={self.host_deadline}, cycle_deadline={self.cycle_deadline})"
+
+    def _run(self, started, host, fn):
+        started[host] = time.monotonic()
+        return fn(self.chargers[host])
+
+    def poll(self, fn, hosts=None):
+        """Call fn(charger) for every host concurrently and collect a PollResult per host.
+
+        fn returns the values to report, None or False when the host could not
+        be polled.
+
+        A host whose previous call is still running (because it overran its
+        deadline) is reported as BUSY and not polled again until it finishes.
+        A host whose circuit breaker is open is reported as OPEN without
+        spending a worker on it.
+        """
+        hosts = list(self.chargers) if hosts is None else hosts
+        cycle_start = time.monotonic()
+        cycle_end = cycle_start + self.cycle_deadline
+        started = {}
+        pending = {}
+        results = {}
+
+        for host in hosts:
+            if host in self._running and not self._running[host].done():
+                results[host] = PollResult(host, pollStatus.BUSY, {}, None, 0)
+                continue
+
+            breaker = self.chargers[host].breaker
+            if breaker is not None and breaker.is_open():
+                results[host] = PollResult(host, pollStatus.OPEN, {}, None, 0)
+                continue
+
+            future = self._executor.submit(self._run, started, host, fn)
+            self._running[host] = future
+            pending[future] = host
+
+        while pending:
+            now = time.monotonic()
+            deadline = cycle_end
+
+            for future, host in list(pending.items()):
+                if host not in started:
+                    continue
+
+                host_end = started[host] + self.host_deadline
+                if host_end <= now:
+                    results[host] = PollResult(host, pollStatus.TIMEOUT, {}, None, now - started[host])
+                    del pending[future]
+                else:
+                    deadline = min(deadline, host_end)
+
+            if not pending:
+                break
+
+            if cycle_end <= now:
+                for future, host in pending.items():
+                    future.cancel()
+                    results[host] = PollResult(host, pollStatus.TIMEOUT, {}, None, now - started.get(host, now))
+                break
+
+            # Hosts still queued for a worker have no deadline yet, so don't sleep
+            # past the point where one of them could have started and expired.
+            done, _ = wait(pending, timeout=min(deadline - now, self.host_deadline), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                host = pending.pop(future)
+                duration = time.monotonic() - started.get(host, cycle_start)
+
+                try:
+                    values = future.result()
+                except Exception as e:
+                    results[host] = PollResult(host, pollStatus.ERROR, {}, e, duration)
+                    continue
+
+                # an empty result is data too, say read_all(delta=True) with nothing changed
+                if values is not None and values is not False:
+                    results[host] = PollResult(host, pollStatus.OK, values, None, duration)
+                else:
+                    results[host] = PollResult(host, pollStatus.ERROR, {}, None, duration)
+
+        return {host: results[host] for host in hosts}
+
+    def read_all(self, rtype=registerType.HOLDING):
+        # read_all() returns nothing at all only when no span could be read
+        return self.poll(lambda charger: charger.read_all(rtype) or None)
+
+    def read_array(self, keys=("meter",), hosts=None):
+        """Read keys from every host and decode them for all hosts at once with NumPy.
+
+        Returns (hosts, keys, values, results): values has one row per host and
+        one column per numeric register in keys, NaN where a host could not be
+        read. results holds the PollResults, with the raw spans as values.
+        """
+        hosts = list(self.chargers) if hosts is None else hosts
+        first = self.chargers[hosts[0]]
+        plans = first._batches_for(first._resolve_keys(keys))
+
+        def read_spans(charger):
+            # one retry budget and the pipeline per charger, as in read_all()
+            return charger._read_spans(plans, charger.retry_policy.deadline()) or None
+
+        results = self.poll(read_spans, hosts)
+        spans = {plan: [results[host].values.get(plan) for host in hosts] for plan in plans}
+        columns, values = decode_spans(plans, spans)
+
+        return hosts, columns, values, results
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+        for charger in self.chargers.values():
+            charger.disconnect()
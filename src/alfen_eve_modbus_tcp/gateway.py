@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+# Modbus TCP gateway, so that dashboards, load balancers and loggers can share a
+# charger that only accepts a few connections. The gateway keeps one persistent
+# connection per charger, polls its full register map on a fixed interval, and
+# serves reads from the last complete poll. Writes to the setpoint registers are
+# forwarded to the charger one at a time, everything else is read-only.
+#
+#   gateway = Gateway([CarCharger(host="10.0.0.2", persistent=True)], port=5020)
+#   gateway.start()
+
+import argparse
+import asyncio
+import collections
+import syslog
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pymodbus.datastore import ModbusBaseSlaveContext, ModbusServerContext
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.server import ModbusTcpServer
+
+from . import BreakerOpenException, CarCharger, registerType, _write_outcome
+from .server import BackgroundServers, READ_FUNCTION_CODES, WRITE_FUNCTION_CODES, _whole_registers
+
+
+# Registers clients may write through the gateway, on every socket
+WRITABLE_KEYS = ("modbus_slave_max_current", "charge_using_1_or_3_phases")
+# Cleared in the snapshot by a forwarded write, until a poll reads the charger's own value
+ACCOUNTED_KEY = "modbus_slave_received_setpoint_accounted_for"
+POLL_INTERVAL = 1
+# Reads fail (slave failure) once the last complete poll is older than this
+MAX_AGE = 10
+
+# memory is {slave: [word, ...]}, never modified once published
+Snapshot = collections.namedtuple("Snapshot", "timestamp memory")
+
+
+class GatewayUpstream:
+    """One charger behind the gateway: its poller, snapshot and write queue."""
+
+    def __init__(self, charger, interval=POLL_INTERVAL, max_age=MAX_AGE, writable=WRITABLE_KEYS):
+        self.charger = charger
+        self.interval = interval
+        self.max_age = max_age
+        self.writable_keys = writable
+        self.snapshot = None
+
+        self.polls = 0
+        self.failures = 0
+        self.writes = 0
+
+        self.plans = []
+        # {slave: set of addresses covered by the polled spans}
+        self.covered = {}
+        # {slave: [(address, length), ...]} clients may write
+        self.writable = {}
+        # {slave: address of ACCOUNTED_KEY}
+        self.accounted = {}
+
+        # the charger's client is not thread safe, polls and writes take turns
+        self._lock = threading.Lock()
+        # writes are forwarded in the order they arrived
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return f"GatewayUpstream({self.charger.host}:{self.charger.port}: polls={self.polls}, failures={self.failures}, writes={self.writes})"
+
+    def _setup(self):
+        charger = self.charger
+        keys = charger._socket_keys(registerType.HOLDING)
+        sockets = [None]
+
+        if charger.socket_slave is not None:
+            sockets += [charger._socket(s) for s in range(1, charger.nr_of_sockets() + 1) if charger._socket(s) is not None]
+
+        self.plans = list(charger._batches(registerType.HOLDING))
+
+        for socket in sockets:
+            if socket is not None:
+                self.plans += charger._batches_for(keys, socket)
+
+            registers = charger._registers_for(socket)
+
+            for k in self.writable_keys:
+                self.writable.setdefault(registers[k].slave, []).append((registers[k].address, registers[k].length))
+
+            if ACCOUNTED_KEY in registers:
+                self.accounted[registers[ACCOUNTED_KEY].slave] = registers[ACCOUNTED_KEY].address
+
+        for plan in self.plans:
+            self.covered.setdefault(plan.slave, set()).update(range(plan.address, plan.address + plan.length))
+
+    def poll(self):
+        """Read every span and publish them as a new snapshot, returns False if any span failed."""
+        with self._lock:
+            try:
+                self.charger._session_begin()
+            except BreakerOpenException:
+                self.failures += 1
+                return False
+
+            spans = {}
+
+            try:
+                spans = self.charger._read_spans(self.plans, self.charger.retry_policy.deadline())
+            except Exception as e:
+                syslog.syslog(f"Failed to poll {self.charger.host}: {e}")
+            finally:
+                self.charger._session_end(failed=len(spans) < len(self.plans))
+
+            # only complete polls are published, so clients never see a mix of old and new spans
+            if len(spans) < len(self.plans):
+                self.failures += 1
+                return False
+
+            memory = {slave: [0] * (max(addresses) + 1) for slave, addresses in self.covered.items()}
+
+            for plan, data in spans.items():
+                memory[plan.slave][plan.address:plan.address + plan.length] = plan.words.unpack(data)
+
+            # still under the lock, so a write forwarded after these reads is never overwritten by them
+            self.snapshot = Snapshot(time.time(), memory)
+            self.polls += 1
+
+        return True
+
+    def read(self, slave, address, count):
+        snapshot = self.snapshot
+
+        if snapshot is None or time.time() - snapshot.timestamp > self.max_age:
+            raise ModbusIOException(f"{self.charger.host}: no recent poll")
+
+        return snapshot.memory[slave][address:address + count]
+
+    def readable(self, slave, address, count):
+        covered = self.covered.get(slave, ())
+        return all(a in covered for a in range(address, address + count))
+
+    def is_writable(self, slave, address, count):
+        return _whole_registers(dict(self.writable.get(slave, ())), address, count)
+
+    def forward(self, slave, address, values):
+        """Write values to the charger, then patch them into the current snapshot."""
+        with self._lock:
+            self.charger._session_begin()
+            outcome = "error"
+
+            try:
+                outcome = _write_outcome(self.charger._write_holding_register(slave, address, values))
+            finally:
+                self.charger._session_end(failed=outcome != "ok")
+
+            if outcome != "ok":
+                raise ModbusIOException(f"{self.charger.host}: write to {slave}:{address} failed ({outcome})")
+
+            self.writes += 1
+            snapshot = self.snapshot
+
+            if snapshot is not None:
+                memory = dict(snapshot.memory)
+                memory[slave] = list(memory[slave])
+                memory[slave][address:address + len(values)] = values
+
+                # the charger accounts for the new setpoint a while later, until a
+                # poll has seen it do so wait_for_setpoint() must keep waiting
+                if slave in self.accounted and self.accounted[slave] < len(memory[slave]):
+                    memory[slave][self.accounted[slave]] = 0
+
+                self.snapshot = Snapshot(snapshot.timestamp, memory)
+
+    def _run(self):
+        # start() already polled once
+        next_poll = time.monotonic() + self.interval
+
+        while not self._stopped.wait(max(next_poll - time.monotonic(), 0)):
+            self.poll()
+
+            next_poll += self.interval
+            now = time.monotonic()
+
+            # skip slots missed by a slow poll instead of polling back-to-back
+            if now > next_poll:
+                next_poll += ((now - next_poll) // self.interval + 1) * self.interval
+
+    def start(self):
+        if self._thread is None:
+            self._setup()
+            self.poll()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name=f"alfen-eve-gateway-{self.charger.host}", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self._writer.shutdown(wait=True)
+        self.charger.disconnect()
+
+
+class GatewaySlave(ModbusBaseSlaveContext):
+
+    def __init__(self, upstream, slave):
+        self.upstream = upstream
+        self.slave = slave
+
+    def validate(self, fc_as_hex, address, count=1):
+        if fc_as_hex in READ_FUNCTION_CODES:
+            return self.upstream.readable(self.slave, address, count)
+        if fc_as_hex in WRITE_FUNCTION_CODES:
+            return self.upstream.is_writable(self.slave, address, count)
+
+        return False
+
+    def getValues(self, fc_as_hex, address, count=1):
+        return self.upstream.read(self.slave, address, count)
+
+    def setValues(self, fc_as_hex, address, values):
+        self.upstream.forward(self.slave, address, values)
+
+    async def async_setValues(self, fc_as_hex, address, values):
+        # the upstream write blocks, keep the event loop serving reads meanwhile
+        await asyncio.get_running_loop().run_in_executor(
+            self.upstream._writer, self.upstream.forward, self.slave, address, list(values)
+        )
+
+
+class GatewayServer(ModbusTcpServer):
+
+    def __init__(self, upstream, address):
+        self.upstream = upstream
+        slaves = {slave: GatewaySlave(upstream, slave) for slave in set(upstream.covered) | set(upstream.writable)}
+        context = ModbusServerContext(slaves=slaves, single=False)
+
+        super().__init__(context, address=address)
+
+
+class Gateway(BackgroundServers):
+
+    server_class = GatewayServer
+    thread_name = "alfen-eve-gateway"
+
+    def __init__(self, chargers, host="127.0.0.1", port=5020, interval=POLL_INTERVAL, max_age=MAX_AGE, writable=WRITABLE_KEYS):
+        """Serve chargers on host, listening on port, port + 1, ...
+
+        With port=0 every charger gets a free port, see addresses. Each charger
+        is polled every interval seconds over its own persistent connection.
+        """
+        super().__init__(host, port)
+        self.upstreams = [GatewayUpstream(charger, interval, max_age, writable) for charger in chargers]
+
+    def __repr__(self):
+        return f"Gateway({len(self.upstreams)} chargers: {self.host}:{self.port})"
+
+    def _targets(self):
+        return self.upstreams
+
+    def start(self):
+        """Start polling every charger, then serve them from an event loop in a background thread."""
+        with ThreadPoolExecutor(max_workers=max(len(self.upstreams), 1)) as executor:
+            list(executor.map(GatewayUpstream.start, self.upstreams))
+
+        super().start()
+
+    def stop(self):
+        super().stop()
+
+        for upstream in self.upstreams:
+            upstream.stop()
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("chargers", type=str, nargs="+", help="Charger host[:port] to connect to")
+    argparser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    argparser.add_argument("--port", type=int, default=5020, help="First Modbus TCP port")
+    argparser.add_argument("--interval", type=float, default=POLL_INTERVAL, help="Poll interval in seconds")
+    argparser.add_argument("--max-age", type=float, default=MAX_AGE, help="Maximum age of served data in seconds")
+    argparser.add_argument("--pipeline", type=int, default=1, help="Requests in flight per upstream connection")
+    args = argparser.parse_args()
+
+    chargers = []
+    for charger in args.chargers:
+        host, _, port = charger.partition(":")
+        chargers.append(CarCharger(host=host, port=int(port or 502), persistent=True, pipeline=args.pipeline))
+
+    gateway = Gateway(chargers, host=args.host, port=args.port, interval=args.interval, max_age=args.max_age)
+    gateway.start()
+    print(f"{gateway}: serving {', '.join(f'{h}:{p}' for h, p in gateway.addresses)}")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        gateway.stop()
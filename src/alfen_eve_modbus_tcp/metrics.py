@@ -0,0 +1,141 @@
+# Prometheus exporter for the AlfenEve instrumentation hooks. Counters and a
+# request duration histogram are kept per charger in memory and rendered in the
+# Prometheus text exposition format, no client library required:
+#
+#   metrics = PrometheusMetrics()
+#   charger = CarCharger(host="10.0.0.2", instrument=metrics)
+#   metrics.serve(9502)
+
+import bisect
+import collections
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import Instrument
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+FUNCTION_NAMES = {3: "read_holding_registers", 16: "write_registers"}
+
+
+def _charger(charger):
+    return f"{charger.host}:{charger.port}"
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def _format(value):
+    # full precision, large counters must not lose digits to exponent notation
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class PrometheusMetrics(Instrument):
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(float)
+        self._histograms = {}
+        self._server = None
+
+    def __repr__(self):
+        return f"PrometheusMetrics({len(self._histograms)} series)"
+
+    def _inc(self, name, labels, value=1):
+        with self._lock:
+            self._counters[name, labels] += value
+
+    def on_connect(self, charger, connected, duration):
+        labels = _labels(charger=_charger(charger), outcome="ok" if connected else "error")
+        self._inc("alfen_connects_total", labels)
+        self._inc("alfen_connect_seconds_total", labels, duration)
+
+    def on_disconnect(self, charger):
+        self._inc("alfen_disconnects_total", _labels(charger=_charger(charger)))
+
+    def on_request(self, charger, event):
+        labels = _labels(charger=_charger(charger), function=FUNCTION_NAMES.get(event.function, event.function), outcome=event.outcome)
+        totals = _labels(charger=_charger(charger))
+        bucket = bisect.bisect_left(self.buckets, event.duration)
+
+        with self._lock:
+            histogram = self._histograms.get(labels)
+            if histogram is None:
+                histogram = self._histograms[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            histogram[0][bucket] += 1
+            histogram[1] += event.duration
+            self._counters["alfen_bytes_sent_total", totals] += event.sent
+            self._counters["alfen_bytes_received_total", totals] += event.received
+
+    def on_retry(self, charger, attempt, reason):
+        self._inc("alfen_retries_total", _labels(charger=_charger(charger), reason=reason))
+
+    def on_decode(self, charger, plan, duration):
+        labels = _labels(charger=_charger(charger))
+        with self._lock:
+            self._counters["alfen_decodes_total", labels] += 1
+            self._counters["alfen_decode_seconds_total", labels] += duration
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (list(v[0]), v[1])) for k, v in self._histograms.items())
+
+        lines = []
+        previous = None
+
+        for (name, labels), value in counters:
+            if name != previous:
+                lines.append(f"# TYPE {name} counter")
+                previous = name
+            lines.append(f"{name}{labels} {_format(value)}")
+
+        if histograms:
+            lines.append("# TYPE alfen_request_duration_seconds histogram")
+
+        for labels, (counts, total) in histograms:
+            cumulative = 0
+            for le, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'alfen_request_duration_seconds_bucket{labels[:-1]},le="{le}"}} {cumulative}')
+            lines.append(f"alfen_request_duration_seconds_sum{labels} {_format(total)}")
+            lines.append(f"alfen_request_duration_seconds_count{labels} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host=""):
+        """Serve render() on http://host:port/metrics from a daemon thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+        return self._server
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
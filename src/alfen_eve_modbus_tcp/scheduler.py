@@ -0,0 +1,242 @@
+# Keeps Modbus setpoints alive. A charger falls back to its safe current once
+# modbus_slave_max_current_valid_time runs out, so every setpoint handed to the
+# SetpointScheduler is rewritten shortly before that happens, over the charger's
+# own (ideally persistent) connection instead of a fresh one per refresh.
+
+import heapq
+import itertools
+import random
+import syslog
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import BreakerOpenException, _write_outcome
+
+
+# Seconds before expiry a setpoint is rewritten
+REFRESH_MARGIN = 10
+# Refreshes are spread over up to this many extra seconds before the margin
+REFRESH_JITTER = 5
+# Refreshes due within this many seconds of each other are written in one pass
+BATCH_WINDOW = 1
+# Seconds to wait before trying a failed refresh again
+REFRESH_RETRY = 2
+# Validity assumed until the charger's own could be read, the charger's default
+DEFAULT_VALIDITY = 60
+MAX_WORKERS = 16
+
+
+class SetpointScheduler:
+
+    def __init__(
+        self, margin=REFRESH_MARGIN, jitter=REFRESH_JITTER, batch_window=BATCH_WINDOW,
+        retry=REFRESH_RETRY, default_validity=DEFAULT_VALIDITY, max_workers=MAX_WORKERS
+    ):
+        self.margin = margin
+        self.jitter = jitter
+        self.batch_window = batch_window
+        self.retry = retry
+        self.default_validity = default_validity
+        self.max_workers = max_workers
+        self.refreshes = 0
+        self.failures = 0
+
+        # charger: [current, validity in seconds (None until read), heap sequence]
+        self._setpoints = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        # serialises the writes to each charger
+        self._charger_locks = {}
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._thread = None
+
+    def __repr__(self):
+        return f"SetpointScheduler({len(self._setpoints)} setpoints: margin={self.margin}, jitter={self.jitter})"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _write(self, charger, sequence):
+        # Writes the charger's setpoint if it is still the one scheduled as
+        # sequence. Returns (written, validity), validity is the one the charger
+        # reports or None when it is not known yet, or None when set() or clear()
+        # superseded the setpoint meanwhile.
+        with self._lock:
+            lock = self._charger_locks.setdefault(charger, threading.Lock())
+
+        # one write per charger at a time, so an older setpoint never lands after
+        # a newer one, and the charger's client is not thread safe
+        with lock:
+            with self._lock:
+                entry = self._setpoints.get(charger)
+
+                if entry is None or entry[2] != sequence:
+                    return None
+
+                current, validity = entry[0], entry[1]
+
+            return self._write_current(charger, current, validity)
+
+    def _write_current(self, charger, current, validity):
+        written = False
+
+        try:
+            charger._session_begin()
+        except BreakerOpenException as e:
+            syslog.syslog(f"Failed to write setpoint to {charger.host}: {e}")
+            return False, None
+
+        try:
+            results = charger.write_many({"modbus_slave_max_current": current})
+            written = all(_write_outcome(result) == "ok" for result in results)
+
+            # the charger's configured validity is learnt from the first write,
+            # the setpoint is in place whether or not that read works
+            if written and validity is None:
+                try:
+                    validity = charger.read("modbus_slave_max_current_valid_time")["modbus_slave_max_current_valid_time"] or None
+                except Exception as e:
+                    syslog.syslog(f"Failed to read setpoint validity from {charger.host}: {e}")
+        except Exception as e:
+            syslog.syslog(f"Failed to write setpoint to {charger.host}: {e}")
+        finally:
+            charger._session_end(failed=not written)
+
+        return written, validity if written else None
+
+    def _schedule(self, charger, written, validity):
+        # called with self._lock held
+        entry = self._setpoints[charger]
+        now = time.monotonic()
+
+        if not written:
+            due = now + self.retry
+        else:
+            if validity is not None:
+                entry[1] = validity
+            else:
+                validity = self.default_validity
+
+            due = now + validity - self.margin - random.uniform(0, self.jitter)
+            due = max(due, now + validity / 2)
+
+        entry[2] = next(self._sequence)
+        heapq.heappush(self._heap, (due, entry[2], charger))
+        self._wakeup.set()
+
+    def set(self, charger, current):
+        """Write `current` to the charger now and keep it alive until clear()."""
+        with self._lock:
+            entry = self._setpoints.get(charger)
+            sequence = next(self._sequence)
+            self._setpoints[charger] = [current, entry[1] if entry else None, sequence]
+
+        result = self._write(charger, sequence)
+
+        # a later set() or clear() took over, it writes and schedules its own setpoint
+        if result is None:
+            return False
+
+        written, validity = result
+
+        with self._lock:
+            entry = self._setpoints.get(charger)
+            if entry is not None and entry[2] == sequence:
+                self._schedule(charger, written, validity)
+
+        return written
+
+    def clear(self, charger):
+        """Stop refreshing the charger, it falls back to its safe current once the setpoint expires."""
+        with self._lock:
+            self._setpoints.pop(charger, None)
+
+    def remaining(self, charger):
+        """Seconds until the next refresh of the charger's setpoint, None if it has none."""
+        with self._lock:
+            entry = self._setpoints.get(charger)
+
+            if entry is None:
+                return None
+
+            for due, sequence, c in self._heap:
+                if sequence == entry[2]:
+                    return max(due - time.monotonic(), 0)
+
+        return None
+
+    def _refresh(self, charger, sequence):
+        result = self._write(charger, sequence)
+
+        if result is None:
+            return
+
+        written, validity = result
+
+        with self._lock:
+            if written:
+                self.refreshes += 1
+            else:
+                self.failures += 1
+
+            entry = self._setpoints.get(charger)
+            if entry is not None and entry[2] == sequence:
+                self._schedule(charger, written, validity)
+
+    def run_pending(self):
+        """Refresh every setpoint due within the batch window, returns seconds until the next one is."""
+        due = []
+
+        with self._lock:
+            horizon = time.monotonic() + self.batch_window
+
+            while self._heap and self._heap[0][0] <= horizon:
+                _, sequence, charger = heapq.heappop(self._heap)
+                entry = self._setpoints.get(charger)
+
+                # skip entries superseded by set() or clear()
+                if entry is not None and entry[2] == sequence:
+                    due.append((charger, sequence))
+
+        if due:
+            list(self._executor.map(lambda args: self._refresh(*args), due))
+
+        with self._lock:
+            if not self._heap:
+                return None
+
+            return max(self._heap[0][0] - time.monotonic(), 0)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            wait = self.run_pending()
+            self._wakeup.wait(wait)
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        # a fresh pool for run_pending() or a later start(), its threads start on first use
+        self._executor.shutdown(wait=True)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
@@ -0,0 +1,100 @@
+# Runs pymodbus TCP servers from an event loop in a background thread, one per
+# target on consecutive ports, for the simulator and the gateway. Subclasses set
+# server_class and return their targets, each served by server_class(target, address).
+
+import asyncio
+import threading
+
+
+READ_FUNCTION_CODES = (3,)
+WRITE_FUNCTION_CODES = (6, 16)
+
+
+def _whole_registers(lengths, address, count):
+    # True if address..address + count covers one or more adjacent registers of
+    # lengths ({address: length}) exactly, a partial write would leave half a
+    # FLOAT32 setpoint
+    end = address + count
+
+    while address < end and address in lengths:
+        address += lengths[address]
+
+    return count > 0 and address == end
+
+
+class BackgroundServers:
+
+    server_class = None
+    thread_name = "alfen-eve-server"
+
+    def __init__(self, host="127.0.0.1", port=5020):
+        """Listen on host, port, port + 1, ..., or on free ports with port=0, see addresses."""
+        self.host = host
+        self.port = port
+        self.addresses = []
+
+        self._loop = None
+        self._thread = None
+        self._servers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _targets(self):
+        raise NotImplementedError
+
+    async def _listen(self):
+        for i, target in enumerate(self._targets()):
+            server = self.server_class(target, (self.host, self.port + i if self.port else 0))
+
+            if not await server.listen():
+                raise OSError(f"Unable to listen on {self.host}:{self.port + i}")
+
+            self._servers.append(server)
+            self.addresses.append((self.host, server.transport.sockets[0].getsockname()[1]))
+
+    def start(self):
+        """Serve all targets from an event loop in a background thread."""
+        started = threading.Event()
+        failure = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+
+            try:
+                self._loop.run_until_complete(self._listen())
+            except Exception as e:
+                failure.append(e)
+                return
+            finally:
+                started.set()
+
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name=self.thread_name, daemon=True)
+        self._thread.start()
+        started.wait()
+
+        if failure:
+            raise failure[0]
+
+    def stop(self):
+        async def shutdown():
+            for server in self._servers:
+                await server.shutdown()
+
+        if self._loop is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+        self._servers = []
+        self.addresses = []
+        self._loop = None
@@ -0,0 +1,193 @@
+# Charging sessions derived from polled samples. A SessionTracker follows the
+# Mode 3 state of one socket: a session opens when a car connects (A -> B/C),
+# closes when it leaves again (-> A), and records the energy meter at both ends
+# and the peak power in between. Finished sessions go to a SessionStore, which
+# writes them to SQLite in batches, at the latest max_delay seconds after the
+# first session of a batch finished.
+#
+#   tracker = SessionTracker("garage", store=SessionStore("sessions.db"))
+#   for sample in car_charger.stream(SESSION_KEYS, interval=5):
+#       tracker.feed(sample)
+
+import collections
+import sqlite3
+import threading
+
+from . import MODE_3_STATE_MAP
+
+
+SESSION_KEYS = ("mode_3_state", "real_energy_delivered_sum", "real_power_sum")
+# Finished sessions buffered before they are written in one transaction
+BATCH_SIZE = 50
+# Seconds a finished session may wait for the rest of its batch
+MAX_DELAY = 60
+
+# start/end are sample timestamps, energies in Wh, peak_power in W
+Session = collections.namedtuple(
+    "Session", "charger start end start_energy end_energy energy peak_power charging_seconds"
+)
+
+
+def _valid(value):
+    return value is not None and value is not False and value == value
+
+
+class SessionTracker:
+
+    def __init__(self, charger="", store=None):
+        self.charger = charger
+        self.store = store
+        self.state = None
+        self.sessions = 0
+
+        # open session: [start, start_energy, last_energy, peak_power, charging_seconds]
+        self._session = None
+        self._last_timestamp = None
+        self._charging = False
+        self._indexes = {}
+
+    def __repr__(self):
+        return f"SessionTracker({self.charger}: state={self.state}, open={self._session is not None}, sessions={self.sessions})"
+
+    def is_open(self):
+        return self._session is not None
+
+    def update(self, timestamp, state, energy=None, power=None):
+        """Feed one poll, returns the Session it closed (or None)."""
+        if state not in MODE_3_STATE_MAP or MODE_3_STATE_MAP[state] == "Error":
+            # unreadable, unknown or error state (F), which says nothing about
+            # a car being connected: keep the current one
+            return None
+
+        connected = MODE_3_STATE_MAP[state] != "NotConnected"
+        session = self._session
+        finished = None
+
+        if session is not None:
+            if self._charging and self._last_timestamp is not None:
+                session[4] += timestamp - self._last_timestamp
+            if _valid(energy):
+                if session[1] is None:
+                    session[1] = energy
+                session[2] = energy
+            if _valid(power) and power > session[3]:
+                session[3] = power
+
+            if not connected:
+                finished = self._close(timestamp)
+        elif connected:
+            start_energy = energy if _valid(energy) else None
+            self._session = [timestamp, start_energy, start_energy, power if _valid(power) else 0.0, 0.0]
+
+        self.state = state
+        self._charging = MODE_3_STATE_MAP[state] == "Charging"
+        self._last_timestamp = timestamp
+
+        return finished
+
+    def _close(self, timestamp):
+        start, start_energy, end_energy, peak_power, charging_seconds = self._session
+        energy = end_energy - start_energy if start_energy is not None else None
+        finished = Session(self.charger, start, timestamp, start_energy, end_energy, energy, peak_power, charging_seconds)
+
+        self._session = None
+        self.sessions += 1
+
+        if self.store is not None:
+            self.store.add(finished)
+
+        return finished
+
+    def feed(self, sample):
+        """Feed a Sample from AlfenEve.stream() that includes SESSION_KEYS."""
+        indexes = self._indexes.get(sample.keys)
+
+        if indexes is None:
+            indexes = self._indexes[sample.keys] = tuple(sample.keys.index(k) for k in SESSION_KEYS)
+
+        values = sample.values
+        return self.update(sample.timestamp, *(values[i] for i in indexes))
+
+
+class SessionStore:
+
+    def __init__(self, path, batch_size=BATCH_SIZE, max_delay=MAX_DELAY):
+        """Store sessions in the SQLite database at path.
+
+        Sessions are written once batch_size of them are pending, or max_delay
+        seconds after the oldest pending one was added, whichever comes first.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._pending = []
+        self._lock = threading.Lock()
+        # flushes the pending sessions once the oldest is max_delay seconds old
+        self._timer = None
+        self._closed = False
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "charger TEXT, start REAL, end REAL, start_energy REAL, end_energy REAL, "
+            "energy REAL, peak_power REAL, charging_seconds REAL)"
+        )
+        self._db.commit()
+
+    def __repr__(self):
+        return f"SessionStore({self.path}: {len(self._pending)} pending)"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, session):
+        with self._lock:
+            if self._closed:
+                raise ValueError(f"{self.path}: session store is closed")
+
+            self._pending.append(tuple(session))
+
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        # called with self._lock held
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self._pending:
+            with self._db:
+                self._db.executemany("INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._pending)
+            self._pending = []
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def sessions(self, charger=None):
+        """Stored sessions, oldest first, pending ones are flushed first."""
+        self.flush()
+
+        with self._lock:
+            if charger is None:
+                rows = self._db.execute("SELECT * FROM sessions ORDER BY start")
+            else:
+                rows = self._db.execute("SELECT * FROM sessions WHERE charger = ? ORDER BY start", (charger,))
+
+            return [Session(*row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+
+            self._flush()
+            self._closed = True
+            self._db.close()
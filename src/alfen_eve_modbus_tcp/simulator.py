@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+# Local stand-in for an Alfen charger, built on the pymodbus server. It serves the
+# full CarCharger register map on the station (0xc8) and socket (0x1) slave IDs,
+# with meter values that follow the Mode 3 state and the written setpoints.
+# Latency, dropped responses and refused connections can be injected, and one
+# Simulator runs hundreds of chargers on consecutive localhost ports.
+
+import argparse
+import asyncio
+import random
+import struct
+import time
+
+from pymodbus.datastore import ModbusBaseSlaveContext, ModbusServerContext
+from pymodbus.exceptions import NoSuchSlaveException
+from pymodbus.server import ModbusTcpServer
+from pymodbus.server.async_io import ModbusServerRequestHandler
+
+from . import CarCharger, registerDataType, STRUCT_FORMATS
+from .server import BackgroundServers, READ_FUNCTION_CODES, WRITE_FUNCTION_CODES, _whole_registers
+
+
+STATION_SLAVE = 0xc8
+SOCKET_SLAVE = 0x1
+
+# Registers the charger accepts writes to (slave, first address, length)
+WRITABLE = {
+    "modbus_slave_max_current": (SOCKET_SLAVE, 0x4ba, 2),
+    "charge_using_1_or_3_phases": (SOCKET_SLAVE, 0x4bf, 1)
+}
+
+MEMORY_SIZE = 0x600
+
+
+def _compile(registers):
+    # name: (slave, address, length, struct), strings use a "<n>s" struct
+    compiled = {}
+
+    for k, v in registers.items():
+        slave, address, length, rtype, dtype, vtype, label, unit, batch = v
+
+        if dtype == registerDataType.STRING:
+            fmt = f">{length * 2}s"
+        else:
+            fmt = ">" + STRUCT_FORMATS[dtype]
+
+        compiled[k] = (slave, address, length, struct.Struct(fmt))
+
+    return compiled
+
+
+class SimulatedCharger:
+
+    name = "SIM_00000"
+    firmware_version = "6.1.0-4159"
+    platform_type = "NG910"
+
+    def __init__(
+        self, serial=0, script=None, loop_script=False,
+        max_current=16.0, safe_current=6.0, car_max_current=16.0, phases=3,
+        validity=60, setpoint_delay=0.5, sockets=1,
+        latency=0, drop_rate=0, refuse_connections=False,
+        registers=CarCharger.registers
+    ):
+        self.serial = serial
+        # every socket mirrors socket 1, served on its own slave ID
+        self.sockets = sockets
+        self.registers = _compile(registers)
+        self.memory = {STATION_SLAVE: [0] * MEMORY_SIZE, SOCKET_SLAVE: [0] * MEMORY_SIZE}
+
+        # [(seconds since start, mode 3 state), ...]
+        self.script = sorted(script or [(0, "A")])
+        self.loop_script = loop_script
+        self.state = self.script[0][1]
+
+        self.max_current = max_current
+        self.safe_current = safe_current
+        self.car_max_current = car_max_current
+        self.phases = phases
+        self.validity = validity
+        self.setpoint_delay = setpoint_delay
+        self.valid_until = 0
+        self.accounted_at = 0
+
+        # fault injection: seconds (or a (min, max) range) per request, share of
+        # requests left unanswered, refuse new connections
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.refuse_connections = refuse_connections
+
+        self.requests = 0
+        self.writes = 0
+        self.dropped = 0
+
+        self.started = time.monotonic()
+        self.updated = self.started
+        self.energy = 0.0
+
+        self._encode_static()
+        self.update()
+
+    def __repr__(self):
+        return f"SimulatedCharger({self.serial}: state={self.state}, max_current={self.max_current}, phases={self.phases})"
+
+    def encode(self, key, value):
+        slave, address, length, fmt = self.registers[key]
+
+        if isinstance(value, str):
+            value = value.encode().ljust(length * 2, b"\x00")[:length * 2]
+
+        self.memory[slave][address:address + length] = struct.unpack(f">{length}H", fmt.pack(value))
+
+    def _encode_static(self):
+        nan = float("nan")
+        static = {
+            "c_name": f"{self.name[:-5]}{self.serial:05d}",
+            "c_manufacturer": "Alfen NV",
+            "c_modbus_table_version": 1,
+            "c_firmware_version": self.firmware_version,
+            "c_platform_type": self.platform_type,
+            "c_station_serial_number": f"ACE{self.serial:07d}",
+            "c_time_zone": 60,
+            "station_active_max_current": 25.0,
+            "ocpp_state": 1,
+            "nr_of_sockets": self.sockets,
+            "meter_type": 0,
+            "availability": 1,
+            "active_load_balancing_safe_current": self.safe_current,
+            "scn_name": "",
+            "scn_max_current_phase_l1": 6.0,
+            "scn_max_current_phase_l2": 6.0,
+            "scn_max_current_phase_l3": 6.0,
+            "scn_safe_current": 6.0
+        }
+
+        for k in self.registers:
+            if k in static:
+                self.encode(k, static[k])
+            elif "energy" in k and k != "real_energy_delivered_sum":
+                self.encode(k, nan)
+
+    def scripted_state(self, now):
+        elapsed = now - self.started
+
+        if self.loop_script and self.script[-1][0] > 0:
+            elapsed %= self.script[-1][0]
+
+        state = self.script[0][1]
+        for at, scripted in self.script:
+            if at > elapsed:
+                break
+            state = scripted
+
+        return state
+
+    def applied_current(self, now):
+        if now > self.valid_until:
+            return self.safe_current
+
+        return self.max_current
+
+    def update(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+
+        if len(self.script) > 1:
+            self.state = self.scripted_state(now)
+
+        applied = self.applied_current(now)
+        charging = self.state in ("C2", "D2")
+        voltages = [230 + random.uniform(-2, 2) for phase in range(3)]
+        currents = [0.0, 0.0, 0.0]
+
+        if charging:
+            for phase in range(self.phases):
+                currents[phase] = min(applied, self.car_max_current) * random.uniform(0.97, 1.0)
+
+        power = [v * i for v, i in zip(voltages, currents)]
+        self.energy += sum(power) * elapsed / 3600
+        wall = time.localtime()
+
+        for k, v in (
+            ("c_date_year", wall.tm_year), ("c_date_month", wall.tm_mon), ("c_date_day", wall.tm_mday),
+            ("c_time_hour", wall.tm_hour), ("c_time_minute", wall.tm_min), ("c_time_second", wall.tm_sec),
+            ("c_uptime", int((now - self.started) * 1000)),
+            ("temperature", 35 + random.uniform(-1, 1)),
+            ("meter_state", 3),
+            ("meter_last_value_timestamp", random.randint(0, 900)),
+            ("voltage_phase_L1N", voltages[0]), ("voltage_phase_L2N", voltages[1]), ("voltage_phase_L3N", voltages[2]),
+            ("current_phase_L1", currents[0]), ("current_phase_L2", currents[1]), ("current_phase_L3", currents[2]),
+            ("current_sum", sum(currents)),
+            ("frequency", 50 + random.uniform(-0.02, 0.02)),
+            ("real_power_phase_L1", power[0]), ("real_power_phase_L2", power[1]), ("real_power_phase_L3", power[2]),
+            ("real_power_sum", sum(power)),
+            ("real_energy_delivered_sum", self.energy),
+            ("mode_3_state", self.state),
+            ("actual_applied_max_current", applied),
+            ("modbus_slave_max_current_valid_time", int(max(self.valid_until - now, 0))),
+            ("modbus_slave_max_current", self.max_current),
+            ("modbus_slave_received_setpoint_accounted_for", int(now >= self.accounted_at)),
+            ("charge_using_1_or_3_phases", self.phases)
+        ):
+            self.encode(k, v)
+
+    def write(self, slave, address, values):
+        for key, (w_slave, w_address, w_length) in WRITABLE.items():
+            if slave != w_slave or not (address <= w_address < address + len(values)):
+                continue
+
+            words = values[w_address - address:w_address - address + w_length]
+            value = self.registers[key][3].unpack(struct.pack(f">{w_length}H", *words))[0]
+            now = time.monotonic()
+
+            if key == "modbus_slave_max_current":
+                self.max_current = value
+                self.valid_until = now + self.validity
+            elif value in (1, 3):
+                self.phases = value
+
+            self.accounted_at = now + self.setpoint_delay
+
+        self.writes += 1
+        self.update()
+
+    def writable(self, slave, address, count):
+        lengths = {w_address: w_length for w_slave, w_address, w_length in WRITABLE.values() if w_slave == slave}
+        return _whole_registers(lengths, address, count)
+
+    async def delay(self):
+        self.requests += 1
+
+        if self.drop_rate and random.random() < self.drop_rate:
+            self.dropped += 1
+            # with ignore_missing_slaves the server leaves the request unanswered
+            raise NoSuchSlaveException("dropped")
+
+        latency = self.latency
+        if isinstance(latency, tuple):
+            latency = random.uniform(*latency)
+        if latency:
+            await asyncio.sleep(latency)
+
+
+class SimulatedSlave(ModbusBaseSlaveContext):
+
+    def __init__(self, charger, slave):
+        self.charger = charger
+        self.slave = slave
+
+    def validate(self, fc_as_hex, address, count=1):
+        if fc_as_hex in READ_FUNCTION_CODES:
+            return 0 <= address and address + count <= MEMORY_SIZE
+        if fc_as_hex in WRITE_FUNCTION_CODES:
+            return self.charger.writable(self.slave, address, count)
+
+        return False
+
+    def getValues(self, fc_as_hex, address, count=1):
+        return self.charger.memory[self.slave][address:address + count]
+
+    def setValues(self, fc_as_hex, address, values):
+        self.charger.write(self.slave, address, values)
+
+    async def async_getValues(self, fc_as_hex, address, count=1):
+        await self.charger.delay()
+        self.charger.update()
+
+        return self.getValues(fc_as_hex, address, count)
+
+    async def async_setValues(self, fc_as_hex, address, values):
+        await self.charger.delay()
+        self.setValues(fc_as_hex, address, values)
+
+
+class _RefusedConnection(ModbusServerRequestHandler):
+
+    def callback_connected(self):
+        self.transport.close()
+
+
+class SimulatedChargerServer(ModbusTcpServer):
+
+    def __init__(self, charger, address):
+        self.charger = charger
+        socket = SimulatedSlave(charger, SOCKET_SLAVE)
+        slaves = {SOCKET_SLAVE + i: socket for i in range(charger.sockets)}
+        slaves[STATION_SLAVE] = SimulatedSlave(charger, STATION_SLAVE)
+        context = ModbusServerContext(slaves=slaves, single=False)
+
+        super().__init__(context, address=address, ignore_missing_slaves=True)
+
+    def callback_new_connection(self):
+        if self.charger.refuse_connections:
+            return _RefusedConnection(self)
+
+        return super().callback_new_connection()
+
+
+class Simulator(BackgroundServers):
+
+    server_class = SimulatedChargerServer
+    thread_name = "alfen-eve-simulator"
+
+    def __init__(self, count=1, host="127.0.0.1", port=5020, **kwargs):
+        """Simulate count chargers on host, listening on port, port + 1, ...
+
+        With port=0 every charger gets a free port, see addresses. Other keyword
+        arguments are passed to every SimulatedCharger.
+        """
+        super().__init__(host, port)
+        self.chargers = [SimulatedCharger(serial=i, **kwargs) for i in range(count)]
+
+    def __repr__(self):
+        return f"Simulator({len(self.chargers)} chargers: {self.host}:{self.port})"
+
+    def _targets(self):
+        return self.chargers
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    argparser.add_argument("--port", type=int, default=5020, help="First Modbus TCP port")
+    argparser.add_argument("--count", type=int, default=1, help="Number of simulated chargers")
+    argparser.add_argument("--sockets", type=int, default=1, help="Sockets per charger")
+    argparser.add_argument("--latency", type=float, default=0, help="Response latency in seconds")
+    argparser.add_argument("--drop-rate", type=float, default=0, help="Share of requests left unanswered")
+    argparser.add_argument("--cycle", type=float, default=0, help="Loop A -> B1 -> C2 -> B2 -> A over this many seconds")
+    args = argparser.parse_args()
+
+    script = None
+    if args.cycle:
+        script = [(0, "A"), (args.cycle * 0.1, "B1"), (args.cycle * 0.2, "C2"), (args.cycle * 0.8, "B2"), (args.cycle * 0.9, "A"), (args.cycle, "A")]
+
+    simulator = Simulator(
+        count=args.count, host=args.host, port=args.port,
+        latency=args.latency, drop_rate=args.drop_rate, sockets=args.sockets,
+        script=script, loop_script=bool(script)
+    )
+    simulator.start()
+    print(f"{simulator}: serving {', '.join(f'{h}:{p}' for h, p in simulator.addresses)}")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
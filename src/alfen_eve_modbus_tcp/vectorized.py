@@ -0,0 +1,91 @@
+# Fleet-wide decoding of raw register spans with NumPy. The same span (say the
+# meter block) read from N chargers is stacked into one buffer and decoded by a
+# single np.frombuffer() with a big-endian structured dtype built from the
+# DecodePlan, instead of N struct.unpack() calls and dicts.
+
+from . import registerDataType, STRUCT_FORMATS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+NUMPY_FORMATS = {
+    "H": ">u2", "I": ">u4", "Q": ">u8", "h": ">i2",
+    "f": ">f4", "d": ">f8"
+}
+
+# ArrayDecoders by DecodePlan, plans are shared by all chargers of a class
+_decoders = {}
+
+
+class ArrayDecoder:
+    """Decodes one DecodePlan span from many chargers into an (N x fields) float64 array.
+
+    String registers are left out, keys lists the columns.
+    """
+
+    def __init__(self, plan):
+        if np is None:
+            raise ImportError("numpy is required for ArrayDecoder")
+
+        self.plan = plan
+        self.itemsize = plan.length * 2
+
+        names, formats, offsets = [], [], []
+
+        for k, v in plan.registers.items():
+            if v.dtype == registerDataType.STRING:
+                continue
+
+            names.append(k)
+            formats.append(NUMPY_FORMATS[STRUCT_FORMATS[v.dtype]])
+            offsets.append((v.address - plan.address) * 2)
+
+        self.keys = tuple(names)
+        self.dtype = np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": self.itemsize})
+
+    def __repr__(self):
+        return f"ArrayDecoder({self.plan}: {len(self.keys)} fields)"
+
+    def decode(self, spans):
+        """Decode a sequence of raw spans (bytes, or None where a charger could not be read).
+
+        Rows of chargers without data are NaN, as are NaN values reported by a charger.
+        """
+        count = len(spans)
+        missing = [i for i, span in enumerate(spans) if span is None]
+
+        if missing:
+            empty = bytes(self.itemsize)
+            spans = [empty if span is None else span for span in spans]
+        if self.plan.order is not None:
+            spans = [self.plan.big_words(span) for span in spans]
+
+        records = np.frombuffer(b"".join(spans), dtype=self.dtype, count=count)
+        values = np.empty((count, len(self.keys)))
+
+        for i, k in enumerate(self.keys):
+            values[:, i] = records[k]
+
+        if missing:
+            values[missing] = np.nan
+
+        return values
+
+
+def decode_spans(plans, spans):
+    """Decode {plan: [span per charger]} into (keys, values) with one column per numeric register."""
+    keys = []
+    columns = []
+
+    for plan in plans:
+        decoder = _decoders.get(plan)
+        if decoder is None:
+            decoder = _decoders[plan] = ArrayDecoder(plan)
+
+        keys.extend(decoder.keys)
+        columns.append(decoder.decode(spans[plan]))
+
+    return tuple(keys), np.hstack(columns) if columns else np.empty((0, 0))